@@ -7,62 +7,165 @@
 import shutil
 import os
 import sys
+import json
+import errno
+import time
+import tarfile
+import zipfile
+import io
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import pydicom
+try:
+    import fcntl  # reflinks (Linux only)
+except ImportError:
+    fcntl = None
 
-# Define functions
-def flatten_sub(root: Path):
-    root = Path(root).resolve()
-    changed = False
+# Set root directory
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(root_dir)
+from dicom_index import index_open, index_headers, index_move, index_link, index_add, read_index_header
+from dicom_duplicates import duplicates_load, raw_suffix
 
-    def get_dir_indices(path: Path):
-        """
-        For a given file path, return a list of numeric indices representing
-        the alphabetical position of each folder *only* if its parent
-        contains multiple subdirectories.
-        """
-        rel_parts = path.relative_to(root).parts[:-1]  # exclude filename
-        indices = []
-        current = root
+# Map for DICOM tags and directories
+tag2directory = {
+    '*fl2d1': 'Localizer',
+    '*tfl3d1_16ns': 'T1w_MPR',
+    '*tfl3d1_256ns': 'T1w_MPR',
+    '*spc_314ns': 'T2w_SPC',
+    'ep_b1495#12': 'dMRI',
+    'epse2d1_140': 'dMRI',
+    'ep_b_dMRI': 'dMRI',
+    'cmrr_mbep2d_diff': 'dMRI',
+    '*tir2d1rs15': 'FLAIR',
+    'epse2d1_104': 'RESTING',
+    'epfid2d1_104': 'RESTING',
+    'cmrr_mbep2d_bold': 'RESTING',
+    'cmrr_mbep2d_se': 'RESTING',
+    'tgse_mv3d1_2480': 'ASL_siemens',
+    'mbPCASL2d1_86': 'pCASL',
+    'epse2d1_86': 'pCASL',
+    '*fl3d1r_t70': 'TOF',
+    '*swi3d1r': 'SWI'
+}
 
-        for part in rel_parts:
-            subdirs = sorted([p.name for p in current.iterdir() if p.is_dir()])
-            if len(subdirs) > 1:  # only assign index if multiple siblings
-                idx = subdirs.index(part)
-                indices.append(idx)
-            current = current / part
+# Only these tags are read from each file: Modality and sequence name (Siemens E11 and XA)
+sort_tags = [[0x08, 0x60], [0x18, 0x24], [0x18, 0x9005]]
 
-        return indices
+# Parallel sorting (1 = serial): concurrent header reads within a subject, and subjects sorted at once.
+# Serial by default; raise one of them (e.g. n_workers = 8 for a network share) rather than both
+n_workers = 1
+n_subject_workers = 1
 
-    # Move all files to root with renaming
-    for path in sorted(root.rglob('*')):
-        if not path.is_file():
-            continue
-        if path.parent == root:
-            continue  # already in root
+# Read headers through the DICOM header index (dicom_index.sqlite), so later stages can reuse them
+use_index = True
+
+# Sorting mode:
+#   "move": the export in <dicom>/<timepoint>/<subject> is flattened and sorted in place
+#   "link": the export in <dicom>/<timepoint><raw_suffix>/<subject> is left untouched and the sorted
+#           <dicom>/<timepoint>/<subject>/<sequence> view is built with reflinks (or hardlinks).
+#           Delete a subject's view to rebuild it, e.g. after changing tag2directory
+#           (raw_suffix is set in dicom_duplicates.py)
+sort_mode = "move"
+
+# Zipped/tarred exports (<subject>.zip, <subject>.tar.gz, ...) found next to the subject folders are
+# streamed straight into the sorted subject folder, without being extracted first
+archive_extensions = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz']
+
+# Archive members are read in memory (at most this many bytes at once, per subject), so that each is written once,
+# straight into its sequence folder. Larger members are written into the subject folder, then moved
+ingest_memory_limit = 64 * 1024 * 1024
+
+# Left in a subject folder while its archive is being ingested: an interrupted ingest is reported, never sorted or overwritten
+ingest_marker = '.ingest'
+
+# Left in a sorted view while it is being linked: an interrupted view is built again on the next run
+link_marker = '.linking'
+
+# Do not sort the subject exports that dicom_duplicates.py found to be copies of another export
+skip_duplicates = False
+
+# Subjects found already sorted (see is_sorted), keyed on the subject folder mtime, so they are not scanned again
+sort_status_path = os.path.join(root_dir, "sort_status.json")
+
+# Define functions
+def scan_tree(root):
+    """
+    Walk a directory tree once with os.scandir. Returns the relative paths
+    (tuples of parts) of all files and directories below root, and for each
+    directory the alphabetical position of each of its subdirectories.
+    """
+    rel_files = []
+    rel_dirs = []
+    sibling_index = {}
+    stack = [()]
+    while stack:
+        rel_dir = stack.pop()
+        subdirs = []
+        with os.scandir(os.path.join(root, *rel_dir)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                    if not entry.is_symlink():
+                        rel_dirs.append(rel_dir + (entry.name,))
+                        stack.append(rel_dir + (entry.name,))
+                elif entry.is_file():
+                    rel_files.append(rel_dir + (entry.name,))
+        sibling_index[rel_dir] = {name: idx for idx, name in enumerate(sorted(subdirs))}
+    return rel_files, rel_dirs, sibling_index
+
+def flat_names(rel_files, sibling_index, taken):
+    """
+    Return the flattened file name for each relative file path. Each folder
+    level adds its alphabetical position to the prefix *only* if its parent
+    contains multiple subdirectories. Names already in taken are avoided, and
+    every returned name is added to taken.
+    """
+    names = []
+    for rel_file in rel_files:
+        indices = []
+        for level, part in enumerate(rel_file[:-1]):
+            siblings = sibling_index[rel_file[:level]]
+            if len(siblings) > 1:  # only assign index if multiple siblings
+                indices.append(siblings[part])
 
-        indices = get_dir_indices(path)
         prefix = '_'.join(map(str, indices)) + '_' if indices else ''
-        new_name = prefix + path.name
-        dest = root / new_name
+        new_name = prefix + rel_file[-1]
 
         # Avoid name collisions
         count = 1
-        while dest.exists():
-            dest = root / f"{prefix}{count}_{path.name}"
+        while new_name in taken:
+            new_name = f"{prefix}{count}_{rel_file[-1]}"
             count += 1
 
-        shutil.move(str(path), dest)
+        taken.add(new_name)
+        names.append(new_name)
+    return names
+
+def flatten_sub(root: Path):
+    root = Path(root).resolve()
+    changed = False
+
+    rel_files, rel_dirs, sibling_index = scan_tree(root)
+
+    # Move all files to root with renaming
+    to_move = sorted(rel_file for rel_file in rel_files if len(rel_file) > 1)  # files already in root stay
+    taken = set(os.listdir(root))
+    for rel_file, new_name in zip(to_move, flat_names(to_move, sibling_index, taken)):
+        shutil.move(os.path.join(root, *rel_file), os.path.join(root, new_name))
         changed = True
 
     # Remove empty dirs (bottom-up)
-    for dir_path in sorted(root.rglob('*'), key=lambda p: len(p.parts), reverse=True):
-        if dir_path.is_dir() and not any(dir_path.iterdir()):
-            dir_path.rmdir()
+    for rel_dir in sorted(rel_dirs, key=len, reverse=True):
+        try:
+            os.rmdir(os.path.join(root, *rel_dir))
             changed = True
-    
-    if changed:
-        print(f"INFO: {root.resolve()} directory was flattened before sorting")
+        except OSError:
+            pass  # not empty
+
+    return changed
 
 def get_sequence_name(dcminfo):
     if dcminfo.get([0x18, 0x24]):
@@ -76,69 +179,342 @@ def get_sequence_name(dcminfo):
 
     return sequence_name
 
-# Set root directory
-root_dir = os.path.dirname(os.path.dirname(__file__))
-sys.path.append(root_dir)
-from meta import meta_func, meta_create
+def read_sort_header(dicom_path):
+    """
+    Read only the tags needed for sorting, stopping before the pixel data.
+    Returns None if the file is not a readable DICOM.
+    """
+    try:
+        dcminfo = pydicom.dcmread(dicom_path, stop_before_pixels=True, specific_tags=sort_tags)
+    except (pydicom.errors.InvalidDicomError, OSError):
+        return None
+    return {"modality": dcminfo.get("Modality"), "sequence_name": get_sequence_name(dcminfo)}
 
-# Create metadata and get DICOM directory path
-meta_create()
-dicoms_path = meta_func("dicom", "the path to the DICOMs folder")  # Path to DICOM directories
-timepoint = meta_func("timepoint", "the name of the timepoint folder (e.g., 'TP2')") # Name of timepoint folder
+def get_sequence_folder(header):
+    """Return the sequence folder (tag2directory value or OTHER) for a DICOM header"""
+    if header["modality"] != 'MR':
+        return 'OTHER'
 
-# Map for DICOM tags and directories
-tag2directory = {
-    '*fl2d1': 'Localizer',
-    '*tfl3d1_16ns': 'T1w_MPR',
-    '*tfl3d1_256ns': 'T1w_MPR',
-    '*spc_314ns': 'T2w_SPC',
-    'ep_b1495#12': 'dMRI',
-    'epse2d1_140': 'dMRI',
-    'ep_b_dMRI': 'dMRI',
-    'cmrr_mbep2d_diff': 'dMRI',
-    '*tir2d1rs15': 'FLAIR',
-    'epse2d1_104': 'RESTING',
-    'epfid2d1_104': 'RESTING',
-    'cmrr_mbep2d_bold': 'RESTING',
-    'cmrr_mbep2d_se': 'RESTING',
-    'tgse_mv3d1_2480': 'ASL_siemens',
-    'mbPCASL2d1_86': 'pCASL',
-    'epse2d1_86': 'pCASL',
-    '*fl3d1r_t70': 'TOF',
-    '*swi3d1r': 'SWI'
-}
+    sequence_name = header["sequence_name"]
+    # Determine sequence ID for diffusion
+    if sequence_name[0:4] == 'ep_b':
+        sequence_id = 'ep_b_dMRI'
+    else:
+        sequence_id = sequence_name # SequenceID for the rest
+
+    return tag2directory.get(sequence_id, 'OTHER')
+
+def read_headers(dicom_paths, header_pool=None, index_conn=None):
+    """
+    Return the sorting header of each file (None if not a readable DICOM).
+    Headers are read concurrently if a thread pool is given, and only for
+    new or changed files if the header index is used.
+    """
+    if index_conn is not None:
+        indexed = index_headers(index_conn, dicom_paths, header_pool)
+        return [indexed[os.path.abspath(dicom_path)] for dicom_path in dicom_paths]
+    elif header_pool is not None:
+        return list(header_pool.map(read_sort_header, dicom_paths))
+    else:
+        return [read_sort_header(dicom_path) for dicom_path in dicom_paths]
+
+def plan_subject(subject_folder, header_pool=None, index_conn=None):
+    """
+    Scan the unsorted files of a subject folder once and return the move plan
+    as a list of (source, destination) paths, plus the files that could not be read.
+    """
+    plan = []
+    unreadable = []
+    with os.scandir(subject_folder) as entries:
+        dicom_paths = [entry.path for entry in entries if entry.is_file()]
+
+    headers = read_headers(dicom_paths, header_pool, index_conn)
+
+    for dicom_path, header in zip(dicom_paths, headers):
+        if header is None:
+            unreadable.append(dicom_path)
+            continue
+        sequence_folder = get_sequence_folder(header)
+        plan.append((dicom_path, os.path.join(subject_folder, sequence_folder, os.path.basename(dicom_path))))
+
+    return plan, unreadable
+
+def apply_plan(plan):
+    """Create the sequence folders and move every file of the plan"""
+    for sequence_folder in {os.path.dirname(new_dicom_path) for _, new_dicom_path in plan}:
+        os.makedirs(sequence_folder, exist_ok=True)
+    for this_dicom_path, new_dicom_path in plan:
+        os.rename(this_dicom_path, new_dicom_path)
 
-# Combine the DICOM path and the timepoint
-dicoms_to_order_folder = os.path.join(dicoms_path, timepoint)
-list_subjects = os.listdir(dicoms_to_order_folder)
-
-# Filter subjects to process based on the file structure
-list_subjects_to_do = [
-    subfolder.name for subfolder in Path(dicoms_to_order_folder).iterdir()
-    if subfolder.is_dir()
-    and (
-        any(f.is_file() for f in subfolder.iterdir())  # are there unsorted files directly in the sub folders?
-        or any(
-            f.is_file() and len(f.relative_to(subfolder).parts) >= 3  # aren't files in second-level folders?
-            for f in subfolder.rglob('*')
+def subject_summary(subject_folder, nSUB, sorted_files, initial_files):
+    """Return the result line of a sorted subject"""
+    list_dir = [entry.name for entry in os.scandir(subject_folder) if entry.is_dir()]
+    n_directories = len(list_dir)
+    list_dir = "    ".join(list_dir)
+
+    # Output result of processing
+    if sorted_files == initial_files:
+        return (
+            f"Processing of subject {nSUB} successfully done.\n"
+            f"{sorted_files} out of {initial_files} files sorted in {n_directories} directories:\n{list_dir}"
         )
-    )
-    and not any(seq_folder.name == "T1w_MPR" for seq_folder in subfolder.rglob('*') if seq_folder.is_dir())  # isn't there a T1 folder?
-]
-
-# Print summary of subjects to process
-print(
-    f"{len(list_subjects_to_do)} out of {len(list_subjects)} subjects will be sorted in chosen folder: {dicoms_to_order_folder}"
-)
-if list_subjects_to_do:
-    print("These subjects are: " + ", ".join(list_subjects_to_do))
-
-# Sort DICOM files
-for nSUB in list_subjects_to_do:
-    print(f"Processing subject {nSUB}...")
-    subject_folder = os.path.join(dicoms_to_order_folder, nSUB)
-        
-    flatten_sub(subject_folder)
+    else:
+        return (
+            f"WARNING: Unable to complete processing of subject {nSUB}.\n"
+            f"{sorted_files} out of {initial_files} files sorted in {n_directories} directories:\n{list_dir}"
+        )
+
+reflink_supported = fcntl is not None
+FICLONE = 0x40049409
+
+def link_file(src, dst):
+    """Reflink dst to src where the filesystem supports it, hardlink it otherwise"""
+    global reflink_supported
+    if reflink_supported:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError as e:
+            if os.path.exists(dst):
+                os.remove(dst)
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                raise
+            reflink_supported = False  # not supported here: hardlink from now on
+    os.link(src, dst)
+
+def link_subject(raw_folder, subject_folder, nSUB, header_pool=None, index_conn=None):
+    """
+    Build the sorted view of a raw export without modifying it. Every file is
+    linked to <subject>/<sequence>/<name>, with the name flatten_sub would give it.
+    The view holds link_marker until it is complete: a view left by an interrupted
+    run is removed (it only holds links) and built again.
+    Returns the subject report as a list of lines.
+    """
+    report = [f"Processing subject {nSUB}..."]
+    marker_path = os.path.join(subject_folder, link_marker)
+    if os.path.lexists(marker_path):
+        shutil.rmtree(subject_folder)
+        report.append("INFO: The sorted view left by an interrupted run was removed and is built again.")
+    os.makedirs(subject_folder, exist_ok=True)
+    with open(marker_path, 'w') as marker_file:
+        marker_file.write(raw_folder + "\n")
+
+    rel_files, _, sibling_index = scan_tree(raw_folder)
+    in_root = [rel_file for rel_file in rel_files if len(rel_file) == 1]
+    nested = sorted(rel_file for rel_file in rel_files if len(rel_file) > 1)
+    names = [rel_file[0] for rel_file in in_root] + flat_names(nested, sibling_index, set(os.listdir(raw_folder)))
+    raw_paths = [os.path.join(raw_folder, *rel_file) for rel_file in in_root + nested]
+
+    others_folder = os.path.join(subject_folder, r'OTHER')
+    os.makedirs(others_folder, exist_ok=True)
+
+    # DICOMDIR goes to OTHER unread, as sort_subject does once flatten_sub has named it DICOMDIR
+    plan = [(raw_path, os.path.join(others_folder, 'DICOMDIR')) for raw_path, name in zip(raw_paths, names) if name == 'DICOMDIR']
+    unreadable = []
+    to_read = [(raw_path, name) for raw_path, name in zip(raw_paths, names) if name != 'DICOMDIR']
+    headers = read_headers([raw_path for raw_path, _ in to_read], header_pool, index_conn)
+    for (raw_path, name), header in zip(to_read, headers):
+        if header is None:
+            unreadable.append(raw_path)
+            continue
+        plan.append((raw_path, os.path.join(subject_folder, get_sequence_folder(header), name)))
+
+    # Link every file of the plan
+    for sequence_folder in {os.path.dirname(new_dicom_path) for _, new_dicom_path in plan}:
+        os.makedirs(sequence_folder, exist_ok=True)
+    linked = []
+    for raw_path, new_dicom_path in plan:
+        try:
+            link_file(raw_path, new_dicom_path)
+            linked.append((raw_path, new_dicom_path))
+        except OSError as e:
+            report.append(f"WARNING: {raw_path} could not be linked into the sorted view: {e}")
+    if index_conn is not None:
+        index_link(index_conn, linked)
+
+    os.remove(marker_path)
+
+    for dicom_path in unreadable:
+        report.append(f"WARNING: {dicom_path} is not a readable DICOM file and was left unsorted.")
+
+    report.append(subject_summary(subject_folder, nSUB, len(linked), len(raw_paths)))
+    return report
+
+def archive_subject(filename):
+    """Return the subject name of an archived export, or None if the file is not an archive"""
+    for extension in archive_extensions:
+        if filename.lower().endswith(extension) and len(filename) > len(extension):
+            return filename[:-len(extension)]
+    return None
+
+def iter_archive(archive_path):
+    """
+    Read the members of a zip or tar archive in a single streaming pass.
+    Yields (relative path parts, is_dir, file object or None, mtime, size).
+    """
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                parts = tuple(part for part in info.filename.split('/') if part not in ('', '.'))
+                if info.is_dir():
+                    yield parts, True, None, None, None
+                else:
+                    with archive.open(info) as member_file:
+                        yield parts, False, member_file, time.mktime(info.date_time + (0, 0, -1)), info.file_size
+    else:
+        with tarfile.open(archive_path, 'r|*') as archive:
+            for member in archive:
+                parts = tuple(part for part in member.name.split('/') if part not in ('', '.'))
+                if member.isdir():
+                    yield parts, True, None, None, None
+                elif member.isfile():
+                    yield parts, False, archive.extractfile(member), member.mtime, member.size
+
+def read_member_header(data, indexed):
+    """Read the header of an archive member held in memory: the index header if indexed, else the sorting header"""
+    return read_index_header(io.BytesIO(data)) if indexed else read_sort_header(io.BytesIO(data))
+
+def write_member(member_file, data, destination, mtime):
+    """Write an archive member (its data if read already, else from its file object) and set its modification time"""
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with open(destination, 'xb') as destination_file:
+        if data is not None:
+            destination_file.write(data)
+        else:
+            shutil.copyfileobj(member_file, destination_file, 1024 * 1024)
+    os.utime(destination, (mtime, mtime))
+
+def ingest_archive(archive_path, subject_folder, nSUB, header_pool=None, index_conn=None):
+    """
+    Sort a zipped/tarred export without extracting it first, in a single streaming pass.
+    Each member up to ingest_memory_limit is read in memory, its header is read there and it
+    is written once, into its sequence folder. The names flatten_sub would give the files depend
+    on every member path, so they are known only at the end of the archive: the files are written
+    under a temporary name and renamed to <subject>/<sequence>/<name> then. Larger members,
+    and members named DICOMDIR, are placed once their name is known. An existing subject folder
+    is never overwritten. Returns the subject report as a list of lines.
+    """
+    report = [f"Processing subject {nSUB} from {os.path.basename(archive_path)}..."]
+    try:
+        os.makedirs(subject_folder)
+    except FileExistsError:
+        report.append(f"WARNING: {subject_folder} already exists, {os.path.basename(archive_path)} was not ingested. Delete the folder to ingest it again.")
+        return report
+    # Marks the subject folder as incomplete until every member is in place (see find_interrupted_ingests)
+    marker_path = os.path.join(subject_folder, ingest_marker)
+    with open(marker_path, 'w') as marker_file:
+        marker_file.write(archive_path + "\n")
+
+    others_folder = os.path.join(subject_folder, r'OTHER')
+    os.makedirs(others_folder, exist_ok=True)
+
+    rel_files = []
+    rel_dirs = []
+    written = {}   # member: (temporary path, header read in memory)
+    deferred = {}  # member: temporary path, placed once its name is known
+    pending = deque()
+    pending_bytes = 0
+
+    def write_pending(i, data, header, mtime):
+        folder = os.path.join(subject_folder, get_sequence_folder(header)) if header is not None else subject_folder
+        written[i] = (os.path.join(folder, f".ingest-{i}"), header)
+        write_member(None, data, written[i][0], mtime)
+
+    # Stream the archive: member paths are only used to name the files, never to write them.
+    # Headers are read concurrently if a thread pool is given, and members written in order
+    for parts, is_dir, member_file, mtime, size in iter_archive(archive_path):
+        if '..' in parts:
+            report.append(f"WARNING: {'/'.join(parts)} in {os.path.basename(archive_path)} points outside the subject folder and was skipped.")
+            continue
+        if not parts:
+            continue
+        if is_dir:
+            rel_dirs.append(parts)
+            continue
+        i = len(rel_files)
+        rel_files.append(parts)
+        rel_dirs.append(parts[:-1])
+        if parts[-1] == 'DICOMDIR' or size > ingest_memory_limit:
+            deferred[i] = os.path.join(others_folder if parts[-1] == 'DICOMDIR' else subject_folder, f".ingest-{i}")
+            write_member(member_file, None, deferred[i], mtime)
+        else:
+            data = member_file.read()
+            if header_pool is not None:
+                pending.append((i, data, header_pool.submit(read_member_header, data, index_conn is not None), mtime))
+                pending_bytes += len(data)
+            else:
+                write_pending(i, data, read_member_header(data, index_conn is not None), mtime)
+        while pending and pending_bytes > ingest_memory_limit:
+            pending_i, data, header, pending_mtime = pending.popleft()
+            pending_bytes -= len(data)
+            write_pending(pending_i, data, header.result(), pending_mtime)
+    while pending:
+        pending_i, data, header, pending_mtime = pending.popleft()
+        write_pending(pending_i, data, header.result(), pending_mtime)
+
+    # An archive of the subject folder itself holds everything under <subject>/
+    if rel_files and all(rel_dir[:1] == (nSUB,) for rel_dir in rel_dirs):
+        rel_files = [rel_file[1:] for rel_file in rel_files]
+        rel_dirs = [rel_dir[1:] for rel_dir in rel_dirs]
+
+    children = {(): set()}
+    for rel_dir in rel_dirs:
+        for level in range(len(rel_dir)):
+            children.setdefault(rel_dir[:level], set()).add(rel_dir[level])
+            children.setdefault(rel_dir[:level + 1], set())
+
+    # Same names as extracting the archive and running flatten_sub
+    sibling_index = {rel_dir: {name: idx for idx, name in enumerate(sorted(subdirs))} for rel_dir, subdirs in children.items()}
+    order = sorted(range(len(rel_files)), key=lambda i: rel_files[i])
+    in_root = [i for i in order if len(rel_files[i]) == 1]
+    nested = [i for i in order if len(rel_files[i]) > 1]
+    names = {i: rel_files[i][0] for i in in_root}
+    taken = set(names.values()) | children[()]
+    names.update(zip(nested, flat_names([rel_files[i] for i in nested], sibling_index, taken)))
+
+    # Rename the written members, as sort_subject would file them (DICOMDIR goes to OTHER unread)
+    plan = []
+    unreadable = []
+    indexed = {}
+    for i, (temp_path, header) in written.items():
+        destination = os.path.join(os.path.dirname(temp_path), names[i])
+        plan.append((temp_path, destination))
+        if header is None:
+            unreadable.append(destination)
+        if index_conn is not None:
+            indexed[destination] = header
+    to_read = [i for i in deferred if names[i] != 'DICOMDIR']
+    plan.extend((deferred[i], os.path.join(others_folder, 'DICOMDIR')) for i in deferred if names[i] == 'DICOMDIR')
+    headers = read_headers([deferred[i] for i in to_read], header_pool, index_conn)
+    read_plan = []
+    for i, header in zip(to_read, headers):
+        if header is None:
+            read_plan.append((deferred[i], os.path.join(subject_folder, names[i])))
+            unreadable.append(read_plan[-1][1])
+        else:
+            read_plan.append((deferred[i], os.path.join(subject_folder, get_sequence_folder(header), names[i])))
+    apply_plan(plan + read_plan)
+    if index_conn is not None:
+        index_add(index_conn, indexed)
+        index_move(index_conn, read_plan)
+    os.remove(marker_path)
+
+    for dicom_path in unreadable:
+        report.append(f"WARNING: {dicom_path} is not a readable DICOM file and was left unsorted.")
+
+    report.append(subject_summary(subject_folder, nSUB, len(plan) + len(read_plan) - len(unreadable), len(rel_files)))
+    return report
+
+def sort_subject(subject_folder, nSUB, header_pool=None, index_conn=None):
+    """
+    Flatten and sort a single subject folder. Returns the subject report as a
+    list of lines, so that parallel runs can print each report in one piece.
+    """
+    report = [f"Processing subject {nSUB}..."]
+    if flatten_sub(subject_folder):
+        report.append(f"INFO: {Path(subject_folder).resolve()} directory was flattened before sorting")
 
     others_folder = os.path.join(subject_folder, r'OTHER')
 
@@ -149,80 +525,199 @@ for nSUB in list_subjects_to_do:
     if os.path.exists(os.path.join(subject_folder, 'DICOM')):
         shutil.rmtree(os.path.join(subject_folder, 'DICOM'))
 
-    # List of all DICOM files
-    all_files_list = [f for f in Path(subject_folder).glob('*') if f.is_file()]
-    
-    # Initial count of files
-    initial_files = sum([
-        1 for file in os.listdir(subject_folder)
-        if os.path.isfile(os.path.join(subject_folder, file))
-    ])
-
-    # Sort files by acquisition time
-    all_files_list.sort(key=os.path.getmtime)
-
-    while all_files_list:
-        # Read the first DICOM file
-        this_dicom = pydicom.dcmread(all_files_list[0])
-
-        if this_dicom.Modality != 'MR':
-            if not os.path.exists(others_folder):
-                os.makedirs(others_folder)
-            os.rename(all_files_list[0], os.path.join(others_folder, all_files_list[0].name))
-            # Redefine unsorted DICOM list and sort
-            all_files_list = [f for f in Path(subject_folder).glob('*') if f.is_file()]
-            all_files_list.sort(key=os.path.getmtime)
-            continue
+    # Read all headers once, then move
+    plan, unreadable = plan_subject(subject_folder, header_pool, index_conn)
+    initial_files = len(plan) + len(unreadable)
+    apply_plan(plan)
+    if index_conn is not None:
+        index_move(index_conn, plan)
 
-        sequence_name = get_sequence_name(this_dicom)
-        # Determine sequence ID for diffusion
-        if sequence_name[0:4] == 'ep_b':
-            sequence_id = 'ep_b_dMRI'
+    for dicom_path in unreadable:
+        report.append(f"WARNING: {dicom_path} is not a readable DICOM file and was left unsorted.")
+
+    # Info: Check if all files were sorted
+    with os.scandir(subject_folder) as entries:
+        sorted_files = initial_files - sum([1 for entry in entries if entry.is_file()])
+    report.append(subject_summary(subject_folder, nSUB, sorted_files, initial_files))
+    return report
+
+def needs_sorting(subject_folder):
+    """
+    A subject folder must be sorted if it has files directly in it or in
+    second-level (or deeper) folders, and no T1w_MPR folder anywhere.
+    The tree is scanned level by level and the scan stops at the first T1w_MPR folder.
+    """
+    has_unsorted_files = False
+    level = [subject_folder]
+    depth = 0
+    while level:
+        next_level = []
+        for folder in level:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if entry.name == "T1w_MPR":  # isn't there a T1 folder?
+                            return False
+                        if not entry.is_symlink():
+                            next_level.append(entry.path)
+                    elif depth != 1 and entry.is_file():  # files directly in the sub folder or in second-level folders
+                        has_unsorted_files = True
+        level = next_level
+        depth += 1
+    return has_unsorted_files
+
+def is_sorted(subject_folder):
+    """
+    A subject folder is sorted if it has a T1w_MPR folder and no files directly in it.
+    Only sorted subjects are cached: an empty export, or one still being copied into
+    nested folders (which does not change the subject folder mtime), is scanned again.
+    """
+    with os.scandir(subject_folder) as entries:
+        entries = list(entries)
+    return (any(entry.name == "T1w_MPR" and entry.is_dir() for entry in entries)
+            and not any(entry.is_file() for entry in entries))
+
+def find_subjects_to_sort(dicoms_to_order_folder, use_cache=True):
+    """
+    Return the subject folders that need sorting. Subjects already found sorted
+    are skipped without scanning while their folder mtime does not change.
+    With use_cache=False every subject is scanned and sort_status.json is left untouched.
+    """
+    sort_status = {}
+    if use_cache and os.path.isfile(sort_status_path):
+        with open(sort_status_path, 'r') as file:
+            sort_status = json.load(file)
+
+    candidates = []
+    with os.scandir(dicoms_to_order_folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                mtime = entry.stat().st_mtime_ns
+                if sort_status.get(os.path.abspath(entry.path)) != mtime:
+                    if os.path.lexists(os.path.join(entry.path, ingest_marker)):
+                        continue  # interrupted archive ingest, see find_interrupted_ingests
+                    candidates.append((entry.name, os.path.abspath(entry.path), mtime))
+
+    with ThreadPoolExecutor(max_workers=max(n_subject_workers, 1)) as pool:
+        to_sort = list(pool.map(needs_sorting, [path for _, path, _ in candidates]))
+        done = list(pool.map(is_sorted, [path for _, path, _ in candidates]))
+
+    list_subjects_to_do = []
+    for (nSUB, path, mtime), sort_it, sorted_already in zip(candidates, to_sort, done):
+        if sort_it:
+            list_subjects_to_do.append(nSUB)
+        elif sorted_already:
+            sort_status[path] = mtime
         else:
-            sequence_id = sequence_name # SequenceID for the rest
+            sort_status.pop(path, None)
+
+    if use_cache:
+        with open(sort_status_path, 'w') as file:
+            json.dump(sort_status, file)
+    return list_subjects_to_do
+
+def find_subjects_to_link(raw_folder, dicoms_to_order_folder):
+    """Return the raw subject exports that do not have a sorted view yet, or whose view is incomplete (it still holds link_marker)"""
+    with os.scandir(raw_folder) as entries:
+        return [entry.name for entry in entries
+                if entry.is_dir() and (not os.path.isdir(os.path.join(dicoms_to_order_folder, entry.name))
+                                       or os.path.lexists(os.path.join(dicoms_to_order_folder, entry.name, link_marker)))]
 
-        # Move files to respective directories
-        if sequence_id in tag2directory.keys():
-            if not os.path.exists(os.path.join(subject_folder, tag2directory[sequence_id])):  
-                os.makedirs(os.path.join(subject_folder, tag2directory[sequence_id]))
-            this_dicom_path = str(all_files_list[0])
-            new_dicom_path = this_dicom_path.replace(subject_folder, os.path.join(subject_folder, tag2directory[sequence_id]), 1)
-            os.rename(this_dicom_path, new_dicom_path)
+def find_archives_to_ingest(source_folder, dicoms_to_order_folder):
+    """Return {subject: archive path} for the archived exports that were not sorted yet"""
+    archives = {}
+    with os.scandir(source_folder) as entries:
+        for entry in entries:
+            nSUB = archive_subject(entry.name) if entry.is_file() else None
+            if nSUB is None:
+                continue
+            if not os.path.lexists(os.path.join(dicoms_to_order_folder, nSUB)):
+                archives[nSUB] = entry.path
+    return archives
 
-        # Same for Sequence_ID not in dictionary
+def find_interrupted_ingests(dicoms_to_order_folder):
+    """Return the subject folders left incomplete by an interrupted archive ingest (they still hold ingest_marker)"""
+    with os.scandir(dicoms_to_order_folder) as entries:
+        return sorted(entry.name for entry in entries
+                      if entry.is_dir() and os.path.lexists(os.path.join(entry.path, ingest_marker)))
+
+def sort_subjects(dicoms_to_order_folder, list_subjects_to_do, raw_folder=None, archives={}):
+    """
+    Sort the given subjects, in parallel if n_workers/n_subject_workers are above 1.
+    If raw_folder is given, the sorted views are linked from the raw exports in it.
+    Subjects in archives are streamed from their zip/tar export.
+    """
+    print_lock = threading.Lock()
+    index_conn = index_open() if use_index else None
+
+    def sort_and_print(nSUB, header_pool):
+        if nSUB in archives:
+            report = ingest_archive(archives[nSUB], os.path.join(dicoms_to_order_folder, nSUB), nSUB, header_pool, index_conn)
+        elif raw_folder is not None:
+            report = link_subject(os.path.join(raw_folder, nSUB), os.path.join(dicoms_to_order_folder, nSUB), nSUB, header_pool, index_conn)
         else:
-            if not os.path.exists(others_folder):
-                os.makedirs(others_folder)
-            this_dicom_path = str(all_files_list[0])
-            new_dicom_path = this_dicom_path.replace(subject_folder, others_folder, 1)
-            os.rename(this_dicom_path, new_dicom_path)
+            report = sort_subject(os.path.join(dicoms_to_order_folder, nSUB), nSUB, header_pool, index_conn)
+        with print_lock:
+            print("\n".join(report))
 
-        # Redefine unsorted DICOM list and sort
-        all_files_list = [f for f in Path(subject_folder).glob('*') if f.is_file()]
-        all_files_list.sort(key=os.path.getmtime)
+    if n_workers <= 1 and n_subject_workers <= 1:
+        for nSUB in list_subjects_to_do:
+            sort_and_print(nSUB, None)
+        return
 
-    # Info: Check if all files were sorted
-    sorted_files = initial_files - sum([
-        1 for file in os.listdir(subject_folder)
-        if os.path.isfile(os.path.join(subject_folder, file))
-    ])
-    n_directories = sum([
-        1 for file in os.listdir(subject_folder)
-        if os.path.isdir(os.path.join(subject_folder, file))
-    ])
-    list_dir = "    ".join([
-        str(item) for item in os.listdir(subject_folder)
-        if os.path.isdir(os.path.join(subject_folder, item))
-    ])
+    # Header reads use their own pool so that subject tasks never wait on a pool they occupy
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as header_pool, \
+         ThreadPoolExecutor(max_workers=max(n_subject_workers, 1)) as subject_pool:
+        futures = [subject_pool.submit(sort_and_print, nSUB, header_pool) for nSUB in list_subjects_to_do]
+        for future in as_completed(futures):
+            future.result()
 
-    # Output result of processing
-    if sorted_files == initial_files:
-        print(
-            f"Processing of subject {nSUB} successfully done.\n"
-            f"{sorted_files} out of {initial_files} files sorted in {n_directories} directories:\n{list_dir}"
-        )
+def main():
+    from meta import meta_func, meta_create
+
+    # Create metadata and get DICOM directory path
+    meta_create()
+    dicoms_path = meta_func("dicom", "the path to the DICOMs folder")  # Path to DICOM directories
+    timepoint = meta_func("timepoint", "the name of the timepoint folder (e.g., 'TP2')") # Name of timepoint folder
+
+    # Combine the DICOM path and the timepoint
+    dicoms_to_order_folder = os.path.join(dicoms_path, timepoint)
+
+    if sort_mode == "link":
+        # Raw exports stay untouched, the sorted view is linked into the timepoint folder
+        raw_folder = os.path.join(dicoms_path, timepoint + raw_suffix)
+        list_subjects = os.listdir(raw_folder)
+        os.makedirs(dicoms_to_order_folder, exist_ok=True)
+        list_subjects_to_do = find_subjects_to_link(raw_folder, dicoms_to_order_folder)
     else:
-        print(
-            f"WARNING: Unable to complete processing of subject {nSUB}.\n"
-            f"{sorted_files} out of {initial_files} files sorted in {n_directories} directories:\n{list_dir}"
-        )
\ No newline at end of file
+        raw_folder = None
+        list_subjects = os.listdir(dicoms_to_order_folder)
+        # Filter subjects to process based on the file structure
+        list_subjects_to_do = find_subjects_to_sort(dicoms_to_order_folder)
+
+    # Zipped/tarred exports
+    archives = find_archives_to_ingest(raw_folder or dicoms_to_order_folder, dicoms_to_order_folder)
+    list_subjects_to_do = [nSUB for nSUB in list_subjects_to_do if nSUB not in archives] + sorted(archives)
+    for nSUB in find_interrupted_ingests(dicoms_to_order_folder):
+        print(f"WARNING: Subject {nSUB} was not fully ingested from its archive and will not be sorted. Delete {os.path.join(dicoms_to_order_folder, nSUB)} to ingest it again.")
+
+    # Duplicate exports found by dicom_duplicates.py
+    if skip_duplicates:
+        duplicates = duplicates_load(dicoms_path)
+        skipped = [nSUB for nSUB in list_subjects_to_do if timepoint + "/" + nSUB in duplicates]
+        for nSUB in skipped:
+            print(f"INFO: Subject {nSUB} is a duplicate of {duplicates[timepoint + '/' + nSUB]} and will not be sorted.")
+        list_subjects_to_do = [nSUB for nSUB in list_subjects_to_do if nSUB not in skipped]
+
+    # Print summary of subjects to process
+    print(
+        f"{len(list_subjects_to_do)} out of {len(list_subjects)} subjects will be sorted in chosen folder: {dicoms_to_order_folder}"
+    )
+    if list_subjects_to_do:
+        print("These subjects are: " + ", ".join(list_subjects_to_do))
+
+    # Sort DICOM files
+    sort_subjects(dicoms_to_order_folder, list_subjects_to_do, raw_folder, archives)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+############################################
+#    WATCH-FOLDER DAEMON FOR DICOM SORTING #
+#             BBSLab Oct 2025              #
+############################################
+
+# Watches dicom/<timepoint> and sorts each subject export as soon as it has
+# finished arriving, without prompts. Paths and sorting options are the ones
+# stored in meta.json and set in Sort_DICOMS.py. Stop it with Ctrl+C.
+
+# Import libraries
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(root_dir)
+import Sort_DICOMS
+from Sort_DICOMS import find_subjects_to_sort, find_subjects_to_link, find_archives_to_ingest, sort_subjects
+from meta import meta_get
+
+# Seconds between two scans of the timepoint folder
+poll_interval = 30
+# An export is complete once its file count, size and newest mtime have not changed for this long
+settle_time = 120
+
+# Define functions
+def export_signature(path):
+    """Return (file count, total size, newest mtime) of an export folder or archive"""
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return 1, stat.st_size, stat.st_mtime_ns
+    n_files = 0
+    total_size = 0
+    newest = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                continue  # moved while scanning
+            n_files += 1
+            total_size += stat.st_size
+            newest = max(newest, stat.st_mtime_ns)
+    return n_files, total_size, newest
+
+def pending_exports(dicoms_to_order_folder, raw_folder):
+    """Return {subject: export path} for every export that still has to be sorted"""
+    source_folder = raw_folder or dicoms_to_order_folder
+    if raw_folder is not None:
+        pending = {nSUB: os.path.join(raw_folder, nSUB) for nSUB in find_subjects_to_link(raw_folder, dicoms_to_order_folder)}
+    else:
+        # Not through the sort_status.json cache: an export polled while it is still arriving must be scanned again
+        pending = {nSUB: os.path.join(dicoms_to_order_folder, nSUB) for nSUB in find_subjects_to_sort(dicoms_to_order_folder, use_cache=False)}
+    pending.update(find_archives_to_ingest(source_folder, dicoms_to_order_folder))
+    return pending
+
+def main():
+    dicoms_path = meta_get("dicom")
+    timepoint = meta_get("timepoint")
+    if dicoms_path == "" or timepoint == "":
+        sys.exit("ERROR: the DICOMs folder and timepoint are not set in meta.json. Run 1-sort/Sort_DICOMS.py once first.")
+
+    dicoms_to_order_folder = os.path.join(dicoms_path, timepoint)
+    raw_folder = os.path.join(dicoms_path, timepoint + Sort_DICOMS.raw_suffix) if Sort_DICOMS.sort_mode == "link" else None
+    os.makedirs(dicoms_to_order_folder, exist_ok=True)
+    print(f"Watching {raw_folder or dicoms_to_order_folder} every {poll_interval} s (exports are sorted after {settle_time} s without changes)")
+
+    last_seen = {}  # subject: (signature, time it was first seen with that signature)
+    handled = {}    # subject: signature it was sorted (or failed) with, not retried until it changes
+    while True:
+        pending = pending_exports(dicoms_to_order_folder, raw_folder)
+        now = time.time()
+        for nSUB, export_path in sorted(pending.items()):
+            signature = export_signature(export_path)
+            if handled.get(nSUB) == signature:
+                continue
+            if nSUB not in last_seen or last_seen[nSUB][0] != signature:
+                last_seen[nSUB] = (signature, now)
+                continue
+            if now - last_seen[nSUB][1] < settle_time:
+                continue
+
+            # The export has settled: sort it now
+            archives = {nSUB: export_path} if os.path.isfile(export_path) else {}
+            try:
+                sort_subjects(dicoms_to_order_folder, [nSUB], raw_folder, archives)
+            except Exception as e:
+                print(f"WARNING: Unable to sort subject {nSUB}: {e}")
+            handled[nSUB] = export_signature(export_path) if os.path.exists(export_path) else None
+            del last_seen[nSUB]
+
+        for nSUB in set(last_seen) - set(pending):
+            del last_seen[nSUB]
+        time.sleep(poll_interval)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Watcher stopped.")
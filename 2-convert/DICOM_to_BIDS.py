@@ -9,8 +9,73 @@ import importlib.util
 import datetime
 import shutil
 import re
+import json
+import time
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# Set root directory (meta.py, dicom_duplicates.py and dicom_index.py)
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(root_dir)
+from heuristic_plan import mapped_folders, mapped_series, build_seqinfo, incomplete_series, index_subject, read_only_variable
+from dicom_duplicates import duplicates_load, raw_suffix
+from nifti_compress import compress_recorded
+
+# Number of subjects converted at the same time (1 = one after the other, with heudiconv output on screen).
+# With more workers, the output of each subject goes to <bids_out>/.mright/logs/
+n_workers = 1
+
+# Failed conversions are retried this many times. Every attempt is recorded in <bids_out>/.mright/conversion_ledger.json,
+# so a re-run redoes subjects whose conversion did not finish instead of treating them as already processed
+max_retries = 1
+
+# Only feed heudiconv the sorted sequence folders holding series that the heuristic maps to a BIDS key
+# (decided from the DICOM headers). Unmapped series (e.g. Localizer, OTHER) are then not parsed by heudiconv
+# and do not appear in .heudiconv/<subject>/info/dicominfo*.tsv
+selective_conversion = False
+
+# Check, from the DICOM headers only, that every series the heuristic maps is complete before converting a subject:
+# no missing instance numbers, no mixed series, and an image count that fits ImagesInAcquisition / NumberOfTemporalPositions.
+# Subjects with an incomplete series (e.g. an unfinished transfer, which heudiconv would convert to *heudiconv* files)
+# are logged in error_heudiconv.txt and skipped. Set to False to convert them anyway
+completeness_check = True
+
+# Do not convert the subject exports that dicom_duplicates.py found to be copies of another export
+skip_duplicates = False
+
+# Submit the conversions as a SLURM array job instead of running them on this machine: one task per subject,
+# each converting into its own folder <bids_out>/.mright/array/<timepoint>/<subject>, merged into <bids_out> when the job ends.
+# With sbatch_command = "local", the tasks run as local processes (local_sbatch.py), e.g. to test the job
+slurm_array = False
+sbatch_command = "sbatch"
+slurm_partition = "batch"
+slurm_time = "1-00:00:00"
+slurm_cpus = 2
+slurm_max_tasks = 20
+
+# Conversion engine: "heudiconv", or "dcm2niix" to skip heudiconv's DICOM re-scan and run dcm2niix directly on each
+# series mapped by the heuristic (dcm2niix_engine.py). Same BIDS output, but no .heudiconv provenance folder
+engine = "heudiconv"
+
+# Local folder (e.g. "/tmp/mright_scratch") where the DICOMs of the next subjects are copied in the background
+# while the current ones convert, so heudiconv reads local disk instead of the network share.
+# Each copy is deleted after its conversion. Leave empty to read the DICOMs in place
+scratch_path = ""
+
+# NIfTI compression: "gzip" to write .nii.gz during the conversion (dcm2niix gzips on several threads when pigz is installed,
+# see 0-env_config), or "background" (engine = "dcm2niix" only) to write uncompressed .nii to <bids_out> and gzip them in
+# parallel blocks (nifti_compress.py) in the background while the next subjects convert. scans.tsv and IntendedFor are
+# renamed to .nii.gz, and the run ends when every file is compressed. compress_threads threads gzip the blocks of a file
+compression = "gzip"
+compress_threads = 4
+
+# error_heudiconv.txt and the job ledger are shared by all workers
+error_lock = threading.Lock()
+ledger_lock = threading.Lock()
+metrics_lock = threading.Lock()
+
 # Function to ensure the directory exists before writing to a file
 def ensure_directory_for_file(file_path):
     """Ensure directory exists before writing to a file"""
@@ -19,6 +84,523 @@ def ensure_directory_for_file(file_path):
         os.makedirs(directory)
         print(f"Created directory: {directory}")
 
+# Function to log a per-subject issue in error_heudiconv.txt
+def log_error(temp_bids_path, subj, message, warning):
+    """Print a warning and append a timestamped line to error_heudiconv.txt, one worker at a time"""
+    error_file = os.path.join(temp_bids_path, "error_heudiconv.txt")
+    with error_lock:
+        ensure_directory_for_file(error_file)
+        with open(error_file, "a") as f:
+            print(warning)
+            f.write(str(datetime.datetime.now()) + "\t" + subj + " " + message + "\n")
+
+# Function to run one heudiconv command
+def run_heudiconv(command, log_path=None):
+    """Run a conversion command (heudiconv or dcm2niix_engine.py), with its output on screen or in log_path. Returns the exit code"""
+    if log_path is None:
+        return subprocess.run(command, shell=True).returncode
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "w") as log:
+        return subprocess.run(command, shell=True, stdout=log, stderr=subprocess.STDOUT).returncode
+
+# Function to load the conversion job ledger
+def ledger_load(temp_bids_path):
+    """Return the job ledger of temp_bids_path: {sub-X[/ses-YY]: {state, exit_code, attempts, started, finished, duration}}"""
+    ledger_path = os.path.join(temp_bids_path, ".mright", "conversion_ledger.json")
+    if os.path.isfile(ledger_path):
+        with open(ledger_path, "r") as f:
+            return json.load(f)
+    return {}
+
+# Function to save the ledger
+def ledger_save(ledger, temp_bids_path):
+    """Save the ledger atomically (temporary file + rename). The caller holds ledger_lock"""
+    ledger_path = os.path.join(temp_bids_path, ".mright", "conversion_ledger.json")
+    os.makedirs(os.path.dirname(ledger_path), exist_ok=True)
+    with open(ledger_path + ".tmp", "w") as f:
+        json.dump(ledger, f, indent=1)
+    os.replace(ledger_path + ".tmp", ledger_path)
+
+# Function to update one job of the ledger
+def ledger_update(ledger, temp_bids_path, key, **fields):
+    """Update a ledger job and save the ledger, one worker at a time"""
+    with ledger_lock:
+        ledger.setdefault(key, {"state": "pending", "exit_code": None, "attempts": 0,
+                                "started": None, "finished": None, "duration": None}).update(fields)
+        ledger_save(ledger, temp_bids_path)
+
+# Function to queue the jobs of a batch in the ledger
+def ledger_queue(ledger, temp_bids_path, keys):
+    """
+    Mark every job of a batch as pending (previous attempts are kept) before any of them starts, with one save.
+    A job still pending in the next run was interrupted before or while it ran: its output is removed and redone
+    """
+    with ledger_lock:
+        for key in keys:
+            ledger.setdefault(key, {"state": "pending", "exit_code": None, "attempts": 0,
+                                    "started": None, "finished": None, "duration": None})["state"] = "pending"
+        ledger_save(ledger, temp_bids_path)
+
+# Function to count the series a subject converts
+def series_count(subject_folder, module):
+    """Return the number of series of a subject mapped by the heuristic (None if it cannot be evaluated on headers alone)"""
+    try:
+        return len(mapped_series(module, build_seqinfo(subject_folder)))
+    except Exception:
+        return None
+
+# Function to measure the DICOMs heudiconv reads
+def dicom_stats(subject_folder, folders):
+    """Return (number of files, bytes) in the given sequence folders of a subject (all of them if folders is None)"""
+    n_files = n_bytes = 0
+    for folder in (folders if folders is not None else list_folders(subject_folder)):
+        with os.scandir(os.path.join(subject_folder, folder)) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    n_files += 1
+                    n_bytes += entry.stat().st_size
+    return n_files, n_bytes
+
+# Function to measure the NIfTIs written for a subject[/session]
+def nifti_stats(output_path):
+    """Return (number of NIfTI files, bytes) under output_path"""
+    n_files = n_bytes = 0
+    for dirpath, _, filenames in os.walk(output_path):
+        for filename in filenames:
+            if filename.endswith((".nii", ".nii.gz")):
+                n_files += 1
+                n_bytes += os.path.getsize(os.path.join(dirpath, filename))
+    return n_files, n_bytes
+
+# Function to append a record to the metrics file
+def metrics_write(temp_bids_path, record):
+    """Append a JSON record to <bids_out>/.mright/conversion_metrics.jsonl, one worker at a time"""
+    metrics_path = os.path.join(temp_bids_path, ".mright", "conversion_metrics.jsonl")
+    with metrics_lock:
+        os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+        with open(metrics_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+# Function to remove the output of an unfinished conversion
+def remove_partial(temp_bids_path, subj, subj_clean, ses, use_sessions):
+    """Delete the BIDS and .heudiconv output of a subject[/session] before converting it again"""
+    if use_sessions:
+        partial_paths = [os.path.join(temp_bids_path, f"sub-{subj_clean}", f"ses-{ses}"),
+                         os.path.join(temp_bids_path, ".heudiconv", subj, f"ses-{ses}")]
+    else:
+        partial_paths = [os.path.join(temp_bids_path, f"sub-{subj_clean}"),
+                         os.path.join(temp_bids_path, ".heudiconv", subj)]
+    for partial_path in partial_paths:
+        if os.path.exists(partial_path):
+            shutil.rmtree(partial_path)
+    os.makedirs(os.path.join(temp_bids_path, f"sub-{subj_clean}"), exist_ok=True)
+
+# Function to choose the sequence folders heudiconv reads
+def subject_folders(subj, dicoms_path, timepoint, module):
+    """
+    Return None to convert the whole sorted subject folder or, with selective_conversion,
+    the list of sequence folders the heuristic maps (empty if it maps none)
+    """
+    if not selective_conversion:
+        return None
+    return mapped_folders(module, os.path.join(dicoms_path, timepoint, subj))
+
+# Function to build the heudiconv input arguments
+def heudiconv_inputs(subj, dicoms_path, timepoint, folders):
+    """Return the heudiconv input arguments for the given folders of a subject (None if there are no folders)"""
+    if folders is None:
+        return "-d "+ os.path.join(dicoms_path, timepoint, "{subject}", "*", "*")
+    if not folders:
+        return None
+    return "--files " + " ".join(os.path.join(dicoms_path, timepoint, subj, folder) for folder in folders)
+
+# Function to build the command of the direct dcm2niix engine
+def dcm2niix_command(subj, dicoms_path, dicoms_root, timepoint, ses, temp_bids_path, heuristic_file_path):
+    """Return the dcm2niix_engine.py command converting a subject (from its scratch copy if dicoms_root is not dicoms_path)"""
+    engine_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "dcm2niix_engine.py")
+    command = sys.executable +" "+ engine_path +" "+ os.path.join(dicoms_path, timepoint, subj) +" -o "+ temp_bids_path +" -f "+ heuristic_file_path +" -s "+ subj
+    if ses is not None:
+        command += " -ss "+ ses
+    if dicoms_root != dicoms_path:
+        command += " --dicoms "+ os.path.join(dicoms_root, timepoint, subj)
+    if compression == "background":
+        command += " --uncompressed"
+    return command
+
+# Function to gzip the NIfTIs of a converted subject
+def compress_subject(temp_bids_path, subj, record, pool):
+    """
+    Gzip the .nii files the dcm2niix engine wrote uncompressed for a converted subject[/session] (compression = "background")
+    with the threads of pool, logging any error. The metrics record of the conversion is then completed with the
+    NIfTI files as compressed, and written
+    """
+    if record["state"] == "done":
+        try:
+            compress_recorded(temp_bids_path, pool, record["subject"])
+        except Exception as e:
+            log_error(temp_bids_path, subj, "compression error: " + str(e),
+                      f"WARNING: The NIfTI files of subject {subj} could not be compressed. Logged in error_heudiconv.txt")
+        record["nifti_files"], record["nifti_bytes"] = nifti_stats(os.path.join(temp_bids_path, record["subject"]))
+    metrics_write(temp_bids_path, record)
+
+# Function to copy a subject to the local scratch folder
+def stage_subject(subj, dicoms_path, timepoint, module, slots):
+    """
+    Copy the sequence folders heudiconv will read to scratch_path/<timepoint>/<subject>.
+    Waits for a free slot first, so at most n_workers + 1 subjects are on scratch at once.
+    Returns (DICOM folder to read from, folders)
+    """
+    slots.acquire()
+    folders = subject_folders(subj, dicoms_path, timepoint, module)
+    source = os.path.join(dicoms_path, timepoint, subj)
+    staged = os.path.join(scratch_path, timepoint, subj)
+    if os.path.exists(staged):
+        shutil.rmtree(staged)
+    os.makedirs(staged)
+    for folder in (folders if folders is not None else sorted(list_folders(source))):
+        shutil.copytree(os.path.join(source, folder), os.path.join(staged, folder))
+    return scratch_path, folders
+
+# Function to remove a subject from the local scratch folder
+def unstage_subject(subj, timepoint, stage, slots):
+    """Wait for the staging of a subject to finish, delete its local copy and free its slot"""
+    stage.exception()
+    shutil.rmtree(os.path.join(scratch_path, timepoint, subj), ignore_errors=True)
+    slots.release()
+
+# Function to check the previous output of a subject
+def prepare_subject(subj, ses, use_sessions, temp_bids_path, ledger):
+    """
+    Check the existing output of a subject[/session] in temp_bids_path. Output left by an unfinished or failed
+    conversion is removed; subjects already processed or with inconsistent session hierarchy are logged.
+    Returns (ledger key, output path), or None if the subject must be skipped
+    """
+    subj_clean = re.sub(r'[^a-zA-Z0-9]', '', subj)
+
+    # Ensure temp_bids_path exists before creating subject directory
+    if not os.path.exists(temp_bids_path):
+        os.makedirs(temp_bids_path, exist_ok=True)
+        print(f"Created output directory: {temp_bids_path}")
+
+    subj_path = os.path.join(temp_bids_path, f"sub-{subj_clean}")
+    # exist_ok: with a multi-worker ALL run, two timepoints of a subject are prepared at once
+    os.makedirs(subj_path, exist_ok=True)
+    subdir_list = [subdir for subdir in os.listdir(subj_path) if os.path.isdir(os.path.join(subj_path, subdir))]
+
+    # For longitudinal studies
+    if use_sessions:
+        ses_path = "ses-{}".format(ses)
+        # ses- check: Subj folder must be empty or contain ONLY ses- subfolders
+        if subdir_list:
+            subdir_check = [ses_subdir for ses_subdir in subdir_list if "ses-" in ses_subdir[:4]]
+            if subdir_check != subdir_list:
+                log_error(temp_bids_path, subj, "session hierarchy issue",
+                          f"WARNING: Subject {subj} has been skipped due to session hierarchy issues. Logged in error_heudiconv.txt")
+                return None
+        key = f"sub-{subj_clean}/{ses_path}"
+        output_path = os.path.join(subj_path, ses_path)
+        previous_output = ses_path in os.listdir(subj_path)
+
+    # For non-longitudinal studies
+    else:
+        # check: Subj folder must be empty
+        key = f"sub-{subj_clean}"
+        output_path = subj_path
+        previous_output = bool(subdir_list)
+
+    if previous_output:
+        if ledger.get(key, {}).get("state") in ["pending", "running", "failed"]:
+            print(f"INFO: Subject {subj} conversion did not finish in a previous run. Its output will be removed and redone.")
+            remove_partial(temp_bids_path, subj, subj_clean, ses, use_sessions)
+        else:
+            log_error(temp_bids_path, subj, "already processed",
+                      f"WARNING: Subject {subj} was previously processed and will be skipped. Logged in error_heudiconv.txt")
+            return None
+    return key, output_path
+
+# Function to convert a single subject
+def convert_subject(subj, dicoms_path, timepoint, ses, use_sessions, temp_bids_path, heuristic_file_path, module, ledger, stage=None, write_metrics=True, prepared=None):
+    """
+    Convert one subject with heudiconv, skipping (and logging) subjects with existing or inconsistent output.
+    Every attempt is recorded in the job ledger: output left by an unfinished or failed
+    conversion is removed and redone, and failed conversions are retried up to max_retries times.
+    If stage (the future of stage_subject) is given, heudiconv reads the local scratch copy.
+    If prepared (the result of prepare_subject) is given, the previous output has already been checked.
+    Returns the metrics record of the conversion (None if the subject was skipped). It is written to the
+    metrics file unless write_metrics is False (background compression: compress_subject writes it).
+    """
+    key = None
+    try:
+        subj_clean = re.sub(r'[^a-zA-Z0-9]', '', subj)
+        if prepared is None:
+            prepared = prepare_subject(subj, ses, use_sessions, temp_bids_path, ledger)
+        if prepared is None:
+            return
+        key, output_path = prepared
+
+        # Pre-flight check of the DICOM headers: do not convert subjects with incomplete or mixed series
+        if completeness_check:
+            incomplete = incomplete_series(module, os.path.join(dicoms_path, timepoint, subj))
+            if incomplete:
+                problems = "; ".join(series_id + ": " + ", ".join(series_problems) for series_id, series_problems in incomplete.items())
+                log_error(temp_bids_path, subj, "incomplete series (" + problems + ")",
+                          f"WARNING: Subject {subj} has incomplete series ({problems}) and will be skipped. Logged in error_heudiconv.txt")
+                return
+
+        # Separate logs when several subjects are converted at once
+        if n_workers > 1:
+            log_path = os.path.join(temp_bids_path, ".mright", "logs", f"sub-{subj_clean}" + (f"_ses-{ses}" if use_sessions else "") + ".log")
+        else:
+            log_path = None
+
+        # For longitudinal studies
+        # Heuristic must have keys like t1w=create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_run-{item:02d}_T1w')
+        if use_sessions:
+            command = "heudiconv {inputs} -o "+ temp_bids_path +" -f "+ heuristic_file_path +" -s "+ subj + " -ss "+ ses +" -c dcm2niix -b --minmeta --overwrite --grouping custom"
+
+        # For non-longitudinal studies
+        # Heuristic must have keys like t1w=create_key('sub-{subject}/anat/sub-{subject}_run-{item:02d}_T1w')
+        else:
+            command = "heudiconv {inputs} -o "+ temp_bids_path +" -f "+ heuristic_file_path +" -s "+ subj +" -c dcm2niix -b --minmeta --overwrite --grouping custom"
+
+        if stage is not None:
+            dicoms_root, folders = stage.result()
+        else:
+            dicoms_root, folders = dicoms_path, subject_folders(subj, dicoms_path, timepoint, module)
+        inputs = heudiconv_inputs(subj, dicoms_root, timepoint, folders)
+        if inputs is None:
+            log_error(temp_bids_path, subj, "no series mapped by the heuristic",
+                      f"WARNING: Subject {subj} has no series mapped by the heuristic and will be skipped. Logged in error_heudiconv.txt")
+            return
+        if engine == "dcm2niix":
+            command = dcm2niix_command(subj, dicoms_path, dicoms_root, timepoint, ses if use_sessions else None, temp_bids_path, heuristic_file_path)
+        else:
+            command = command.replace("{inputs}", inputs)
+        n_dicoms, dicom_bytes = dicom_stats(os.path.join(dicoms_root, timepoint, subj), folders)
+        n_series = series_count(os.path.join(dicoms_path, timepoint, subj), module)
+        subject_start = time.monotonic()
+
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                print(f"INFO: Retrying subject {subj} conversion ({attempt}/{max_retries})")
+                remove_partial(temp_bids_path, subj, subj_clean, ses, use_sessions)
+            else:
+                print(f"Starting subject {subj} conversion")
+            start = time.monotonic()
+            ledger_update(ledger, temp_bids_path, key, state="running", exit_code=None,
+                          attempts=ledger.get(key, {}).get("attempts", 0) + 1,
+                          started=str(datetime.datetime.now()), finished=None, duration=None)
+            exit_code = run_heudiconv(command, log_path)
+            done = exit_code == 0 and os.path.isdir(output_path) and os.listdir(output_path) != []
+            ledger_update(ledger, temp_bids_path, key, state="done" if done else "failed", exit_code=exit_code,
+                          finished=str(datetime.datetime.now()), duration=round(time.monotonic() - start, 1))
+            if done:
+                break
+
+        if not done:
+            log_error(temp_bids_path, subj, f"conversion failed (exit code {exit_code})",
+                      f"WARNING: Subject {subj} conversion failed after {max_retries + 1} attempt(s). Logged in error_heudiconv.txt")
+        elif log_path is not None:
+            print(f"Finished subject {subj} conversion. Log: {log_path}")
+
+        n_niftis, nifti_bytes = nifti_stats(output_path)
+        metrics = {"subject": key, "timepoint": timepoint, "state": "done" if done else "failed", "exit_code": exit_code,
+                   "attempts": attempt + 1, "wall_time": round(time.monotonic() - subject_start, 1),
+                   "series": n_series, "dicom_files": n_dicoms, "dicom_bytes": dicom_bytes, "nifti_files": n_niftis, "nifti_bytes": nifti_bytes,
+                   "finished": str(datetime.datetime.now())}
+        if write_metrics:
+            metrics_write(temp_bids_path, metrics)
+        return metrics
+
+    except Exception as e:
+        try:
+            if key is not None:
+                ledger_update(ledger, temp_bids_path, key, state="failed", finished=str(datetime.datetime.now()))
+            log_error(temp_bids_path, subj, "error: " + str(e),
+                      f"WARNING: Unable to process subject {subj} due to an error. Logged in error_heudiconv.txt")
+        except Exception as err:
+            print(f"ERROR: Could not log error for subject {subj}: {err}")
+
+# Function to write and submit the SLURM array job
+def submit_array(jobs, temp_bids_path):
+    """
+    Write the (subject, timepoint) list and the array job script to <bids_out>/.mright/array/ and submit it,
+    waiting until every task has finished. Returns the sbatch exit code
+    """
+    array_dir = os.path.join(temp_bids_path, ".mright", "array")
+    os.makedirs(os.path.join(array_dir, "logs"), exist_ok=True)
+    subjects_file = os.path.join(array_dir, "subjects.txt")
+    with open(subjects_file, "w") as f:
+        f.write("".join(subj + "\t" + tp + "\n" for subj, tp in jobs))
+
+    job_script = os.path.join(array_dir, "convert_array.sh")
+    with open(job_script, "w") as f:
+        f.write(f"""#!/bin/bash
+#SBATCH --job-name=dicom2bids
+#SBATCH --ntasks=1
+#SBATCH --array=0-{len(jobs) - 1}%{slurm_max_tasks}
+#SBATCH -o {os.path.join(array_dir, "logs", "%A_%a.out")}
+#SBATCH --cpus-per-task={slurm_cpus}
+#SBATCH --nodes=1
+#SBATCH --partition={slurm_partition}
+#SBATCH --time={slurm_time}
+
+# The tasks only read the DICOM header index, which was brought up to date before submitting
+export {read_only_variable}=1
+
+# Convert line number SLURM_ARRAY_TASK_ID of subjects.txt into {array_dir}/<timepoint>/<subject>
+{sys.executable} {os.path.realpath(__file__)} --task {subjects_file} $SLURM_ARRAY_TASK_ID
+""")
+
+    if sbatch_command == "local":
+        command = sys.executable +" "+ os.path.join(os.path.dirname(os.path.realpath(__file__)), "local_sbatch.py")
+    else:
+        command = sbatch_command
+    print(f"Submitting {len(jobs)} conversion task(s): {job_script}")
+    return subprocess.run(command +" --wait "+ job_script, shell=True).returncode
+
+# Function to merge a folder tree into another
+def merge_tree(source, destination):
+    """
+    Move the content of source into destination. New files and folders are moved, existing folders are merged,
+    and existing participants.tsv, error_heudiconv.txt and .bidsignore files only get the lines they are missing.
+    Other existing files (dataset_description.json, README, ...) are kept
+    """
+    os.makedirs(destination, exist_ok=True)
+    for entry in os.listdir(source):
+        source_entry = os.path.join(source, entry)
+        destination_entry = os.path.join(destination, entry)
+        if not os.path.lexists(destination_entry):
+            shutil.move(source_entry, destination_entry)
+        elif os.path.isdir(source_entry) and os.path.isdir(destination_entry):
+            merge_tree(source_entry, destination_entry)
+        elif entry in ["participants.tsv", "error_heudiconv.txt", ".bidsignore"]:
+            with open(destination_entry, "r") as f:
+                destination_lines = {line.rstrip("\n") for line in f}
+            with open(source_entry, "r") as f:
+                new_lines = [line.rstrip("\n") for line in f if line.rstrip("\n") not in destination_lines]
+            if new_lines:
+                with open(destination_entry, "a") as f:
+                    f.write("\n".join(new_lines) + "\n")
+
+# Function to merge the output of an array task
+def merge_array_output(task_bids_path, temp_bids_path, ledger):
+    """Merge the BIDS folder of an array task into temp_bids_path, with its ledger jobs and metrics. Returns its metrics records"""
+    task_mright = os.path.join(task_bids_path, ".mright")
+    for key, job in ledger_load(task_bids_path).items():
+        job["attempts"] += ledger.get(key, {}).get("attempts", 0)
+        ledger_update(ledger, temp_bids_path, key, **job)
+    records = []
+    metrics_path = os.path.join(task_mright, "conversion_metrics.jsonl")
+    if os.path.isfile(metrics_path):
+        with open(metrics_path, "r") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        for record in records:
+            metrics_write(temp_bids_path, record)
+    for name in ["conversion_ledger.json", "conversion_metrics.jsonl"]:
+        if os.path.isfile(os.path.join(task_mright, name)):
+            os.remove(os.path.join(task_mright, name))
+    merge_tree(task_bids_path, temp_bids_path)
+    shutil.rmtree(task_bids_path)
+    return records
+
+# Function to run the conversions as a SLURM array job
+def run_array(todo_dicoms, dicoms_path, use_sessions, temp_bids_path, ledger):
+    """Convert the (subject, timepoint) jobs as a SLURM array job and merge their output into temp_bids_path. Returns the metrics records"""
+    prepared = {(subj, tp): prepare_subject(subj, session_label(tp), use_sessions, temp_bids_path, ledger) for subj, tp in todo_dicoms}
+    jobs = [job for job in todo_dicoms if prepared[job] is not None]
+    if not jobs:
+        return []
+    ledger_queue(ledger, temp_bids_path, [prepared[job][0] for job in jobs])
+    array_dir = os.path.join(temp_bids_path, ".mright", "array")
+    for subj, tp in jobs:
+        if os.path.exists(os.path.join(array_dir, tp, subj)):
+            shutil.rmtree(os.path.join(array_dir, tp, subj))
+
+    # The tasks open the index read-only (many of them at once, often on a shared file system): index their headers now
+    if selective_conversion or completeness_check or engine == "dcm2niix":
+        for subj, tp in jobs:
+            index_subject(os.path.join(dicoms_path, tp, subj))
+
+    exit_code = submit_array(jobs, temp_bids_path)
+    if exit_code != 0:
+        print(f"WARNING: The array job ended with exit code {exit_code}. Task logs: {os.path.join(array_dir, 'logs')}")
+
+    records = []
+    for subj, tp in jobs:
+        task_bids_path = os.path.join(array_dir, tp, subj)
+        if os.path.isdir(task_bids_path):
+            records.extend(merge_array_output(task_bids_path, temp_bids_path, ledger))
+        else:
+            log_error(temp_bids_path, subj, "array task did not run",
+                      f"WARNING: The array task of subject {subj} did not run. Logged in error_heudiconv.txt")
+    return [record for record in records if not record.get("summary")]
+
+# Function to run one array task
+def run_array_task(subjects_file, task_id):
+    """Convert line number task_id of subjects_file into <bids_out>/.mright/array/<timepoint>/<subject>, with the paths stored in meta.json"""
+    from meta import meta_get
+
+    dicoms_path = meta_get("dicom")
+    temp_bids_path = meta_get("bids_out")
+    heuristic_file_path = meta_get("heuristic")
+    module = load_heuristic(heuristic_file_path)
+
+    with open(subjects_file, "r") as f:
+        subj, timepoint = f.read().splitlines()[task_id].split("\t")
+    ses = session_label(timepoint)
+    use_sessions = (ses != "NOSESSION")
+    task_bids_path = os.path.join(temp_bids_path, ".mright", "array", timepoint, subj)
+    background_compression = compression == "background" and engine == "dcm2niix"
+    record = convert_subject(subj, dicoms_path, timepoint, ses, use_sessions, task_bids_path, heuristic_file_path, module,
+                             ledger_load(task_bids_path), write_metrics=not background_compression)
+    if record is not None and background_compression:
+        with ThreadPoolExecutor(max_workers=compress_threads) as pool:
+            compress_subject(task_bids_path, subj, record, pool)
+    return 0 if record is not None and record["state"] == "done" else 1
+
+# Function to load the heuristic file
+def load_heuristic(heuristic_file_path):
+    """Dynamically load and execute a heuristic module to access configuration settings for processing"""
+    heuristic_module_name = os.path.basename(heuristic_file_path).split('.')[0]
+    spec = importlib.util.spec_from_file_location(heuristic_module_name, heuristic_file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Function to get the session label of a timepoint
+def session_label(timepoint):
+    """Return the session label of a timepoint folder: its numerical part, zero-padded (e.g. TP2 -> 02)"""
+    return ''.join(filter(str.isdigit, timepoint)).zfill(2)
+
+# Function to list the timepoint folders
+def list_timepoints(dicoms_path):
+    """Return the timepoint folders of the DICOM directory (folders with a number, e.g. TP1, TP2), without the <timepoint>_raw export folders"""
+    return sorted(name for name in list_folders(dicoms_path)
+                  if any(char.isdigit() for char in name) and not name.startswith(".") and not name.endswith(raw_suffix))
+
+# Function to list the subjects[/sessions] of a BIDS directory
+def list_bids(bids_path, use_sessions):
+    """Return the (subject, session folder) pairs of a BIDS directory, in one pass (session folder is "" without sessions)"""
+    bids = set()
+    with os.scandir(bids_path) as subjects:
+        for subject in subjects:
+            if subject.name[:4] != "sub-":
+                continue
+            if not use_sessions:
+                bids.add((subject.name[4:], ""))
+            elif subject.is_dir():
+                with os.scandir(subject.path) as sessions:
+                    bids.update((subject.name[4:], session.name) for session in sessions if session.is_dir())
+    return bids
+
+# Function to print a list of conversions
+def describe_jobs(jobs, timepoints):
+    """Return the subjects of (subject, timepoint) jobs as text, with their timepoint if there are several"""
+    if len(timepoints) == 1:
+        return str({subj for subj, _ in jobs})
+    return str(sorted(f"{subj} ({tp})" for subj, tp in jobs))
+
 # Function to list folders in a given directory
 def list_folders(path):
     """Return a list of folder (subjects) names in the given directory."""
@@ -30,47 +612,56 @@ def list_folders(path):
 
 def main():
     # Import meta functions
-    root_dir = os.path.dirname(os.path.dirname(__file__))
-    sys.path.append(root_dir)
-    from meta import meta_func, meta_create
+    from meta import meta_func, meta_create, meta_get, meta_set
 
     # Input paths
     meta_create()
     dicoms_path = meta_func("dicom", "the path to the DICOMs folder")  # Path to DICOM directories
-    timepoint = meta_func("timepoint", "the name of the timepoint folder (e.g., 'TP2')") # Name of timepoint folder
+    stored_timepoint = meta_get("timepoint")
+    timepoint = meta_func("timepoint", "the name of the timepoint folder (e.g., 'TP2', or 'ALL' for every timepoint)") # Name of timepoint folder
+    if timepoint.upper() == "ALL":
+        # "ALL" only applies to this run: the other scripts read the timepoint from meta.json
+        meta_set("timepoint", stored_timepoint if stored_timepoint.upper() != "ALL" else "")
     bids_path = meta_func("bids_in", "the path to the (shared) BIDS folder")  # Path to shared BIDS directory
     temp_bids_path = meta_func("bids_out", "the path to the temporary (local) BIDS output folder")  # Path to local BIDS directory
     heuristic_file_path = meta_func("heuristic", "your heuristic file path") # Path to heuristic file
 
-    # Extract the numerical part of timepoint from above and format 
-    ses = ''.join(filter(str.isdigit, timepoint)).zfill(2)  
+    # Timepoints to convert: the given folder, or every timepoint folder of the DICOM directory with "ALL"
+    if timepoint.upper() == "ALL":
+        timepoints = list_timepoints(dicoms_path)
+        print("Timepoints to be processed:", timepoints)
+    else:
+        timepoints = [timepoint]
+
+    # Sessions are the numerical part of each timepoint (see session_label)
+    use_sessions = (session_label(timepoints[0]) != "NOSESSION") if timepoints else True
 
     # Dynamically load and execute a heuristic module to access configuration settings for processing
-    heuristic_module_name = os.path.basename(heuristic_file_path).split('.')[0]
-    spec = importlib.util.spec_from_file_location(heuristic_module_name, heuristic_file_path)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
+    module = load_heuristic(heuristic_file_path)
 
     delete_scans = module.delete_scans
     delete_events = module.delete_events
 
-    use_sessions = (ses != "NOSESSION")
-    
-    # List of DICOMS in input directory 
-    dicoms_folders = set(list_folders(os.path.join(dicoms_path, timepoint)))
+    # List of DICOMS in input directory: (subject, timepoint) pairs
+    dicoms_folders = {(sub, tp) for tp in timepoints for sub in list_folders(os.path.join(dicoms_path, tp))}
 
-    # Determine subjects to process in BIDS
-    if use_sessions:
-        ses_path = "ses-{}".format(ses)
-        bids = [s[4:] for s in os.listdir(bids_path) if ((s[:4] == "sub-") and os.path.isdir(os.path.join(bids_path, s, ses_path)))]
-    else:
-        bids = [s[4:] for s in os.listdir(bids_path) if ((s[:4] == "sub-"))]
+    # Duplicate exports found by dicom_duplicates.py
+    if skip_duplicates:
+        duplicates = duplicates_load(dicoms_path)
+        skipped = {(sub, tp) for sub, tp in dicoms_folders if tp + "/" + sub in duplicates}
+        for sub, tp in sorted(skipped):
+            print(f"INFO: Subject {sub} ({tp}) is a duplicate of {duplicates[tp + '/' + sub]} and will not be converted.")
+        dicoms_folders -= skipped
+
+    # Determine subjects[/sessions] already in BIDS, listing the shared BIDS directory once
+    bids = list_bids(bids_path, use_sessions)
+    bids_key = lambda sub, tp: (sub, "ses-{}".format(session_label(tp)) if use_sessions else "")
 
     # Identify subjects needing processing
-    todo_dicoms = {sub for sub in dicoms_folders if sub not in bids}
+    todo_dicoms = {(sub, tp) for sub, tp in dicoms_folders if bids_key(sub, tp) not in bids}
 
     # Identify subjects that do not need processing
-    intersection_bids_list = dicoms_folders.intersection(bids)
+    intersection_bids_list = {(sub, tp) for sub, tp in dicoms_folders if bids_key(sub, tp) in bids}
     
     # If there are no subjects in both dicoms_folders and bids_path
     if intersection_bids_list == set():                                             
@@ -78,22 +669,23 @@ def main():
 
     # If there are subjects in both dicoms_folders and bids_path
     while (intersection_bids_list != set()) is True:                                
-        overwrite_bids = input(str(intersection_bids_list) +
+        overwrite_bids = input(describe_jobs(intersection_bids_list, timepoints) +
                             " already in BIDS directory, do you want to overwrite? (Y/N) ").upper()
         # No overwriting: todo_dicoms = dicoms in list not in bids_path
         if overwrite_bids == "N":                                                 
             todo_dicoms = []
-            for sub in dicoms_folders:
+            for sub, tp in dicoms_folders:
                 sub_clean = re.sub(r'[^a-zA-Z0-9]', '', sub)
-                if sub_clean not in bids:
-                    todo_dicoms.append(sub)
-            print("Skipped overwriting of " + str(intersection_bids_list) + ".")
+                if bids_key(sub_clean, tp) not in bids:
+                    todo_dicoms.append((sub, tp))
+            print("Skipped overwriting of " + describe_jobs(intersection_bids_list, timepoints) + ".")
             intersection_bids_list = set()
 
         # Overwriting: delete BIDS in conflict, convert the entire list    
         elif overwrite_bids == "Y":                                                
             if use_sessions == True:
-                for dicom_id in dicoms_folders:
+                for dicom_id, tp in dicoms_folders:
+                    ses_path = "ses-{}".format(session_label(tp))
                     if os.path.exists(os.path.join(bids_path, "sub-{}".format(dicom_id), ses_path)):
                         shutil.rmtree(os.path.join(bids_path, "sub-{}".format(dicom_id), ses_path))
                         print("INFO: " + os.path.join(bids_path, "sub-{}".format(dicom_id), ses_path) + " will be overwritten.")
@@ -102,7 +694,7 @@ def main():
                         print("INFO: " + os.path.join(bids_path, ".heudiconv", dicom_id, ses_path) + " will be overwritten.")
             
             else:            
-                for dicom_id in dicoms_folders:
+                for dicom_id, _ in dicoms_folders:
                     if os.path.exists(os.path.join(bids_path, "sub-{}".format(dicom_id))):
                         shutil.rmtree(os.path.join(bids_path, "sub-{}".format(dicom_id)))
                         print("INFO: " + os.path.join(bids_path, "sub-{}".format(dicom_id)) + " will be overwritten.")
@@ -116,65 +708,81 @@ def main():
             print("Please, enter a valid response.\n") 
 
     # Print the list of subjects to be processed
-    print("Subjects to be processed:", todo_dicoms)
+    print("Subjects to be processed:", describe_jobs(todo_dicoms, timepoints))
 
-    # Heudiconv run
-    for subj in todo_dicoms:
+    # Heudiconv run: every (subject, timepoint) conversion in one batch
+    ledger = ledger_load(temp_bids_path)
+    todo_dicoms = sorted(todo_dicoms, key=lambda job: (job[1], job[0]))
+    # Check the previous output of every job first: skipped subjects are not staged
+    prepared = {}
+    if not slurm_array:
+        prepared = {(subj, tp): prepare_subject(subj, session_label(tp), use_sessions, temp_bids_path, ledger) for subj, tp in todo_dicoms}
+        todo_dicoms = [job for job in todo_dicoms if prepared[job] is not None]
+        ledger_queue(ledger, temp_bids_path, [prepared[job][0] for job in todo_dicoms])
+    stages = {}
+    if scratch_path and not slurm_array:
+        # One copy at a time, in conversion order, at most one subject ahead of the conversion workers
+        slots = threading.Semaphore(n_workers + 1)
+        staging_pool = ThreadPoolExecutor(max_workers=1)
+        stages = {(subj, tp): staging_pool.submit(stage_subject, subj, dicoms_path, tp, module, slots) for subj, tp in todo_dicoms}
+
+    # Background compression: one subject at a time, its files gzipped by compress_threads threads
+    background_compression = compression == "background" and engine == "dcm2niix" and not slurm_array
+    if compression == "background" and engine != "dcm2niix":
+        print("WARNING: compression = 'background' needs engine = 'dcm2niix'. The NIfTI files will be gzipped during the conversion.")
+    compressions = []
+    if background_compression:
+        compress_pool = ThreadPoolExecutor(max_workers=compress_threads)
+        background_pool = ThreadPoolExecutor(max_workers=1)
+
+    def convert(job):
+        subj, tp = job
         try:
-            subj_clean = re.sub(r'[^a-zA-Z0-9]', '', subj)
-
-            # Ensure temp_bids_path exists before creating subject directory
-            if not os.path.exists(temp_bids_path):
-                os.makedirs(temp_bids_path)
-                print(f"Created output directory: {temp_bids_path}")
-
-            subj_path = os.path.join(temp_bids_path, f"sub-{subj_clean}")
-            if not os.path.exists(subj_path):
-                os.mkdir(subj_path)
-            subdir_list = [subdir for subdir in os.listdir(subj_path) if os.path.isdir(os.path.join(subj_path, subdir))]
-
-            # For longitudinal studies
-            # Heuristic must have keys like t1w=create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_run-{item:02d}_T1w')
-            if use_sessions:
-                # ses- check: Subj folder must be empty or contain ONLY ses- subfolders
-                if subdir_list:
-                    subdir_check = [ses_subdir for ses_subdir in subdir_list if "ses-" in ses_subdir[:4]]
-                    if subdir_check != subdir_list:
-                        with open(os.path.join(temp_bids_path, "error_heudiconv.txt"), "a") as f:
-                            print(f"WARNING: Subject {subj} has been skipped due to session hierarchy issues. Logged in error_heudiconv.txt")
-                            f.write(str(datetime.datetime.now()) + "\t" + subj + " session hierarchy issue\n")
-                        continue
-                if ses_path not in os.listdir(subj_path):
-                    print(f"Starting subject {subj} conversion")
-                    command = "heudiconv -d "+ os.path.join(dicoms_path, timepoint, "{subject}", "*", "*") + " -o "+ temp_bids_path +" -f "+ heuristic_file_path +" -s "+ subj + " -ss "+ ses +" -c dcm2niix -b --minmeta --overwrite --grouping custom"
-                    os.system(command)
-                else:
-                    with open(os.path.join(temp_bids_path, "error_heudiconv.txt"), "a") as f:
-                        print(f"WARNING: Subject {subj} was previously processed and will be skipped. Logged in error_heudiconv.txt")
-                        f.write(str(datetime.datetime.now()) + "\t" + subj + " already processed\n")
-            
-            # For non-longitudinal studies
-            # Heuristic must have keys like t1w=create_key('sub-{subject}/anat/sub-{subject}_run-{item:02d}_T1w')        
-            else:
-                # check: Subj folder must be empty
-                if not subdir_list:
-                    print(f"Starting subject {subj} conversion")
-                    command = "heudiconv -d "+ os.path.join(dicoms_path, timepoint, "{subject}", "*", "*") + " -o "+ temp_bids_path +" -f "+ heuristic_file_path +" -s "+ subj +" -c dcm2niix -b --minmeta --overwrite --grouping custom"
-                    os.system(command)
-                else:
-                    with open(os.path.join(temp_bids_path, "error_heudiconv.txt"), "a") as f:
-                        print(f"WARNING: Subject {subj} was previously processed and will be skipped. Logged in error_heudiconv.txt")
-                        f.write(str(datetime.datetime.now()) + "\t" + subj + " already processed\n")
-        
-        except Exception as e:
-            try:
-                ensure_directory_for_file(os.path.join(temp_bids_path, "error_heudiconv.txt"))
-                with open(os.path.join(temp_bids_path, "error_heudiconv.txt"), "a") as f:
-                    print(f"WARNING: Unable to process subject {subj} due to an error. Logged in error_heudiconv.txt")
-                    f.write(str(datetime.datetime.now()) + "\t" + subj + " error: " + str(e) + "\n")
-            except Exception as err:
-                print(f"ERROR: Could not log error for subject {subj}: {err}")
-            continue
+            record = convert_subject(subj, dicoms_path, tp, session_label(tp), use_sessions, temp_bids_path, heuristic_file_path, module, ledger,
+                                     stages.get(job), write_metrics=not background_compression, prepared=prepared.get(job))
+            if background_compression and record is not None:
+                compressions.append(background_pool.submit(compress_subject, temp_bids_path, subj, record, compress_pool))
+            return record
+        finally:
+            if job in stages:
+                unstage_subject(subj, tp, stages[job], slots)
+
+    run_start = time.monotonic()
+    if slurm_array:
+        records = run_array(todo_dicoms, dicoms_path, use_sessions, temp_bids_path, ledger)
+    elif n_workers > 1:
+        # heudiconv protects the shared top-level BIDS files (participants.tsv, ...) with heudiconv.lock
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            records = list(pool.map(convert, todo_dicoms))
+    else:
+        records = [convert(job) for job in todo_dicoms]
+    if stages:
+        staging_pool.shutdown()
+    if background_compression:
+        if compressions:
+            print("INFO: Waiting for the background compression of the NIfTI files to finish")
+        background_pool.shutdown()
+        compress_pool.shutdown()
+
+    # End-of-run summary in the metrics file
+    records = [record for record in records if record is not None]
+    if records:
+        wall_time = time.monotonic() - run_start
+        summary = {"summary": True, "timepoint": timepoint, "subjects": len(records),
+                   "failed": sum(1 for record in records if record["state"] != "done"),
+                   "wall_time": round(wall_time, 1), "n_workers": n_workers}
+        for field in ["dicom_files", "dicom_bytes", "nifti_files", "nifti_bytes"]:
+            summary[field] = sum(record[field] for record in records)
+        # series is None when the heuristic cannot be evaluated on headers alone
+        summary["series"] = sum(record.get("series") or 0 for record in records)
+        summary["series_per_s"] = round(summary["series"] / wall_time, 2) if wall_time else None
+        summary["files_per_s"] = round(summary["dicom_files"] / wall_time, 1) if wall_time else None
+        summary["mb_per_s"] = round(summary["dicom_bytes"] / 1e6 / wall_time, 2) if wall_time else None
+        summary["finished"] = str(datetime.datetime.now())
+        metrics_write(temp_bids_path, summary)
+        print(f"INFO: {summary['subjects']} subject(s) processed ({summary['failed']} failed) in {summary['wall_time']} s "
+              f"({summary['series_per_s']} series/s, {summary['files_per_s']} DICOM files/s, {summary['mb_per_s']} MB/s). "
+              f"Metrics in {os.path.join(temp_bids_path, '.mright', 'conversion_metrics.jsonl')}")
 
     # .bidsignore file in case error_heudiconv.txt is created
     if os.path.exists(os.path.join(temp_bids_path, "error_heudiconv.txt")):
@@ -212,4 +820,7 @@ def main():
             print("WARNING: Invalid value for 'delete_events' variable in heuristics file. No deletion of *_events.tsv files was done.")
 
 if __name__ == '__main__':
+    # SLURM array task: DICOM_to_BIDS.py --task <subjects file> <task id>
+    if len(sys.argv) == 4 and sys.argv[1] == "--task":
+        sys.exit(run_array_task(sys.argv[2], int(sys.argv[3])))
     main()
@@ -0,0 +1,190 @@
+############################################
+#######    DIRECT DCM2NIIX ENGINE     ######
+#######       BBSLab Oct 2025         ######
+############################################
+
+# Converts one sorted subject[/session] to BIDS without heudiconv's DICOM re-scan and .heudiconv provenance:
+# the series come from the DICOM header index, dcm2niix runs once per series mapped by the heuristic, and
+# heudiconv's own BIDS functions name the outputs and write the sidecars, scans.tsv, participants.tsv,
+# top-level files and IntendedFor, so the BIDS output is the same as heudiconv's.
+#
+# Called by DICOM_to_BIDS.py when engine = "dcm2niix":
+#   python dcm2niix_engine.py <sorted subject folder> -o <BIDS output> -f <heuristic> -s <subject> [-ss <session>] [--dicoms <copy of the subject folder>] [--uncompressed]
+
+import os
+import re
+import sys
+import glob
+import logging
+import argparse
+import subprocess
+import importlib.util
+from types import SimpleNamespace
+import filelock
+from nipype.interfaces.base import Undefined
+from heudiconv.bids import sanitize_label, add_participant_record, populate_bids_templates, save_scans_key, tuneup_bids_json_files, populate_intended_for
+from heudiconv.convert import LOCKFILE, conversion_info, convert_dicom, save_converted_files, add_taskname_to_infofile
+from heudiconv.utils import TempDirs, treat_infofile, set_readonly
+from heuristic_plan import group_series, seqinfo_from
+from nifti_compress import record_uncompressed
+
+lgr = logging.getLogger("mright.dcm2niix_engine")
+
+def nipype_outputs(files):
+    """Return a list of output files the way nipype's Dcm2niix reports them: one path or a list"""
+    return files[0] if len(files) == 1 else files
+
+def run_dcm2niix(item_dicoms, prefix, outtype, tmpdir):
+    """
+    Convert the DICOMs of one series with dcm2niix (same options heudiconv passes through nipype).
+    dcm2niix converts whole folders, so the series is isolated in a folder of symlinks: other series
+    of the same sequence folder (e.g. the SBRef next to the BOLD) are not converted with it.
+    Returns a nipype-like result for heudiconv's save_converted_files
+    """
+    source_dir = os.path.join(tmpdir, "dicoms")
+    output_dir = os.path.join(tmpdir, "out")
+    os.makedirs(source_dir)
+    os.makedirs(output_dir)
+    for i, dicom in enumerate(item_dicoms):
+        os.symlink(os.path.realpath(dicom), os.path.join(source_dir, "%05d_%s" % (i, os.path.basename(dicom))))
+
+    command = ["dcm2niix", "-b", "y", "-z", "n" if outtype == "nii" else "y", "-x", "n", "-t", "n", "-m", "0", "-w", "2",
+               "-f", os.path.basename(prefix), "-o", output_dir, "-s", "n", "-v", "n", source_dir]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    lgr.debug(result.stdout)
+    # dcm2niix may use return code 1 despite conversion
+    if result.returncode not in (0, 1):
+        raise RuntimeError("dcm2niix failed on {} (exit code {}):\n{}".format(prefix, result.returncode, result.stdout))
+
+    files = sorted(glob.glob(os.path.join(output_dir, "*")))
+    bvecs = [f for f in files if f.endswith(".bvec")]
+    bvals = [f for f in files if f.endswith(".bval")]
+    return SimpleNamespace(outputs=SimpleNamespace(
+        converted_files=nipype_outputs([f for f in files if f.endswith((".nii", ".nii.gz"))]),
+        bids=nipype_outputs([f for f in files if f.endswith(".json")]),
+        bvecs=nipype_outputs(bvecs) if bvecs else Undefined,
+        bvals=nipype_outputs(bvals) if bvals else Undefined))
+
+def convert_items(items, outdir, heuristic, uncompressed=False):
+    """
+    Convert the (prefix, outtypes, DICOMs) items of heudiconv's conversion_info, as heudiconv's convert does with --minmeta --overwrite.
+    With uncompressed, nii.gz outputs are written as .nii (to be gzipped later by nifti_compress.py).
+    Returns these .nii files
+    """
+    tempdirs = TempDirs()
+    uncompressed_files = []
+    for prefix, outtypes, item_dicoms in items:
+        if isinstance(outtypes, str):
+            outtypes = (outtypes,)
+        deferred = uncompressed and "nii.gz" in outtypes
+        if uncompressed:
+            outtypes = tuple("nii" if outtype == "nii.gz" else outtype for outtype in outtypes)
+        lgr.info("Converting %s (%d DICOMs) -> %s . Output types: %s", prefix, len(item_dicoms), os.path.dirname(prefix), outtypes)
+        if outtypes != ("dicom",):
+            os.makedirs(os.path.dirname(prefix), exist_ok=True)
+
+        bids_outfiles = []
+        outname = ""
+        for outtype in outtypes:
+            if outtype == "dicom":
+                convert_dicom(item_dicoms, "", prefix, outdir, tempdirs, True, True)
+            elif outtype in ["nii", "nii.gz"]:
+                outname = prefix + "." + outtype
+                tmpdir = tempdirs("dcm2niix")
+                res = run_dcm2niix(item_dicoms, prefix, outtype, tmpdir)
+                bids_outfiles = save_converted_files(res, item_dicoms, "", outtype, prefix, prefix + ".json", overwrite=True)
+                if bids_outfiles:
+                    save_scans_key((prefix, outtypes, item_dicoms), bids_outfiles)
+                if deferred:
+                    # bids_outfiles are the sidecars: one .nii per sidecar (several for multi-echo series), or outname
+                    nii_files = {f[:-len(".json")] + ".nii" for f in bids_outfiles if f.endswith(".json")} | {outname}
+                    uncompressed_files.extend(sorted(f for f in nii_files if os.path.exists(f)))
+                tuneup_bids_json_files(bids_outfiles)
+                tempdirs.rmtree(tmpdir)
+            else:
+                raise ValueError("Unsupported output type {} for {}".format(outtype, prefix))
+
+        add_taskname_to_infofile(bids_outfiles)
+        scaninfo = prefix + getattr(heuristic, "scaninfo_suffix", ".json")
+        if os.path.exists(scaninfo):
+            treat_infofile(scaninfo)
+        if outname and os.path.exists(outname):
+            set_readonly(outname)
+        custom_callable = getattr(heuristic, "custom_callable", None)
+        if custom_callable is not None:
+            custom_callable(prefix, outtypes, item_dicoms)
+
+    # Populate "IntendedFor" for fmap files, once per subject[/session]
+    populate_intended_for_opts = getattr(heuristic, "POPULATE_INTENDED_FOR_OPTS", None)
+    if populate_intended_for_opts is not None:
+        sessions = set()
+        for prefix, _, _ in items:
+            match = re.search("sub-(?P<subj>[a-zA-Z0-9]*)([{0}_]ses-(?P<ses>[a-zA-Z0-9]*))?".format(os.sep), prefix)
+            if not match:
+                sessions.clear()
+                break
+            sessions.add(match.group(0))
+        for session in sessions:
+            populate_intended_for(os.path.join(outdir, session), **populate_intended_for_opts)
+    return uncompressed_files
+
+def convert_session(subject_folder, outdir, heuristic, subject, session=None, dicoms_folder=None, uncompressed=False):
+    """
+    Convert a sorted subject folder to BIDS under outdir. Headers are read from the DICOM header
+    index of subject_folder; if dicoms_folder (a copy of subject_folder) is given, dcm2niix reads it instead.
+    With uncompressed, the NIfTIs are written as .nii
+    """
+    subject = sanitize_label(subject)
+    if session:
+        session = sanitize_label(session)
+
+    # The seqinfo is built from the index: a heuristic's custom_seqinfo needs the DICOMs themselves
+    if hasattr(heuristic, "custom_seqinfo"):
+        raise RuntimeError("The heuristic defines custom_seqinfo, which the dcm2niix engine does not support. Use engine = \"heudiconv\"")
+    series = group_series(subject_folder)
+    seqinfo = seqinfo_from(series)
+    if not seqinfo:
+        raise RuntimeError("No DICOM series found in {}".format(subject_folder))
+    filegroup = {}
+    for s in seqinfo:
+        files = [path for path, _ in series[s.series_uid]]
+        if dicoms_folder:
+            files = [os.path.join(dicoms_folder, os.path.relpath(path, subject_folder)) for path in files]
+        filegroup[s.series_id] = files
+
+    info = heuristic.infotodict(seqinfo)
+    items = conversion_info(subject, outdir, info, filegroup, session)
+    uncompressed_files = convert_items(items, outdir, heuristic, uncompressed)
+    if uncompressed:
+        record_uncompressed(outdir, "sub-" + subject + ("/ses-" + session if session else ""), uncompressed_files)
+
+    # Shared top-level files, one conversion at a time
+    with filelock.SoftFileLock(os.path.join(outdir, LOCKFILE), timeout=float(os.getenv("HEUDICONV_LOCKFILE_TIMEOUT", -1))):
+        add_participant_record(outdir, subject, seqinfo[0].patient_age, seqinfo[0].patient_sex)
+        populate_bids_templates(outdir, getattr(heuristic, "DEFAULT_FIELDS", {}))
+    lgr.info("PROCESSING DONE: %s", {"subject": subject, "outdir": outdir, "session": session})
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a sorted subject folder to BIDS with dcm2niix, using a heudiconv heuristic")
+    parser.add_argument("subject_folder", help="sorted subject folder (<DICOM directory>/<timepoint>/<subject>)")
+    parser.add_argument("-o", dest="outdir", required=True, help="BIDS output folder")
+    parser.add_argument("-f", dest="heuristic", required=True, help="heuristic file")
+    parser.add_argument("-s", dest="subject", required=True, help="subject label")
+    parser.add_argument("-ss", dest="session", help="session label")
+    parser.add_argument("--dicoms", help="copy of the subject folder to convert from (e.g. on local scratch)")
+    parser.add_argument("--uncompressed", action="store_true", help="write .nii instead of .nii.gz")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+    # Load the heuristic module as DICOM_to_BIDS.py does
+    heuristic_module_name = os.path.basename(args.heuristic).split('.')[0]
+    spec = importlib.util.spec_from_file_location(heuristic_module_name, args.heuristic)
+    heuristic = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(heuristic)
+
+    convert_session(os.path.abspath(args.subject_folder), os.path.abspath(args.outdir), heuristic,
+                    args.subject, args.session, args.dicoms and os.path.abspath(args.dicoms), args.uncompressed)
+
+if __name__ == '__main__':
+    sys.exit(main())
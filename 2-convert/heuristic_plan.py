@@ -0,0 +1,253 @@
+############################################
+#######  HEURISTIC PLANNING FUNCTIONS  #####
+#######       BBSLab Oct 2025        #######
+############################################
+
+# Builds heudiconv-like seqinfo records straight from DICOM headers (through the
+# DICOM header index) and evaluates a heuristic on them, without running heudiconv
+
+import os
+import sys
+import math
+import threading
+from heudiconv.utils import SeqInfo
+
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(root_dir)
+from dicom_index import index_open, index_headers
+
+# Set in the environment of SLURM array tasks (DICOM_to_BIDS.py slurm_array): many tasks read the index at once,
+# so they open it read-only, and the index is brought up to date before the job is submitted (index_subject)
+read_only_variable = "MRIGHT_INDEX_READ_ONLY"
+
+index_conn = None
+index_conn_lock = threading.Lock()
+
+def get_index():
+    """Return the shared connection to the DICOM header index (read-only if read_only_variable is set to 1)"""
+    global index_conn
+    with index_conn_lock:
+        if index_conn is None:
+            index_conn = index_open(read_only=os.environ.get(read_only_variable) == "1")
+    return index_conn
+
+def series_files(subject_folder):
+    """Return the files heudiconv reads for a sorted subject: <subject>/*/*"""
+    files = []
+    with os.scandir(subject_folder) as folders:
+        for folder in folders:
+            if folder.is_dir():
+                with os.scandir(folder.path) as entries:
+                    files.extend(entry.path for entry in entries if entry.is_file())
+    return files
+
+def index_subject(subject_folder, pool=None):
+    """Bring the index entries of the files of a sorted subject folder up to date"""
+    index_headers(get_index(), series_files(subject_folder), pool)
+
+def group_series(subject_folder, pool=None):
+    """Return {series UID: [(path, header), ...]} for the DICOMs of a sorted subject folder. Only headers of new or changed files are read"""
+    headers = index_headers(get_index(), series_files(subject_folder), pool)
+    series = {}
+    for path, header in sorted(headers.items()):
+        if header is None or header["series_uid"] is None:
+            continue
+        series.setdefault(header["series_uid"], []).append((path, header))
+    return series
+
+def header_number(value):
+    """Return a numeric header value as an int, or None if it is missing or not a number"""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def is_mosaic(files):
+    """Siemens mosaics hold all the slices of a volume in one image: one file per volume (repetition)"""
+    return "MOSAIC" in (files[0][1]["image_type"] or "").split("\\")
+
+def header_float(value, default):
+    """Return a numeric header value as a float, or default if it is missing or not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def image_size(files):
+    """
+    Return (dim1, dim2, dim3, dim4) of a series as heudiconv computes them from the image shape of its first file:
+    rows, columns, slices and volumes. Siemens mosaics hold ImagesInAcquisition slices per file, one file per volume
+    """
+    header = files[0][1]
+    rows, columns = header_number(header["rows"]) or 0, header_number(header["columns"]) or 0
+    n_frames = header_number(header["number_of_frames"]) or 1
+    if is_mosaic(files):
+        n_slices = header_number(header["images_in_acquisition"]) or 1
+        tiles = math.ceil(math.sqrt(n_slices))
+        return rows // tiles, columns // tiles, n_slices, len(files)
+    if n_frames > 1:
+        n_volumes = header_number(header["number_of_temporal_positions"]) or 1
+        return rows, columns, n_frames // n_volumes, n_volumes
+    return rows, columns, len(files), 1
+
+def seqinfo_from(series):
+    """
+    Return one heudiconv SeqInfo per series of group_series, ordered by series number. Every field is filled
+    from the indexed headers of the series' first file as heudiconv does, except series_files (the number of files,
+    as in heudiconv: use group_series for the paths) and custom (None: custom_seqinfo needs the DICOMs themselves)
+    """
+    seqinfo = []
+    for series_uid, files in series.items():
+        path, header = files[0]
+        series_number = header["series_number"] or "0"
+        image_type = tuple(header["image_type"].split("\\")) if header["image_type"] else ()
+        date = header["acquisition_date"]
+        time = header["acquisition_time"]
+        if not (date and time) and header["acquisition_datetime"]:
+            date, time = header["acquisition_datetime"][:8], header["acquisition_datetime"][8:]
+        fields = dict(
+            example_dcm_file=os.path.basename(path),
+            series_id='-'.join([series_number, header["protocol_name"] or ""]),
+            dcm_dir_name=os.path.basename(os.path.dirname(path)),
+            series_files=len(files),
+            unspecified="",
+            TR=header_float(header["repetition_time"], -1000) / 1000,
+            TE=header_float(header["echo_time"], -1),
+            protocol_name=header["protocol_name"] or "",
+            is_motion_corrected="MOCO" in image_type,
+            is_derived="derived" in [value.lower() for value in image_type],
+            patient_id=header["patient_id"],
+            study_description=header["study_description"],
+            referring_physician_name=header["referring_physician_name"] or "",
+            series_description=header["series_description"] or "",
+            sequence_name=header["sequence_name"] or "",
+            image_type=image_type,
+            accession_number=header["accession_number"],
+            patient_age=header["patient_age"],
+            patient_sex=header["patient_sex"],
+            date=date or None,
+            series_uid=series_uid,
+            time=time or None,
+            custom=None)
+        fields.update(zip(["dim1", "dim2", "dim3", "dim4"], image_size(files)))
+        seqinfo.append(fields)
+    seqinfo.sort(key=lambda fields: (int(float(fields["series_id"].split('-')[0] or 0)), fields["time"] or "", fields["series_uid"]))
+
+    # Files of this series and the ones before it, counted in order as heudiconv does
+    total_files = 0
+    for fields in seqinfo:
+        total_files += fields["series_files"]
+        fields["total_files_till_now"] = total_files
+    # Only the fields of the installed heudiconv version (older versions have fewer)
+    return [SeqInfo(**{field: fields.get(field) for field in SeqInfo._fields}) for fields in seqinfo]
+
+def build_seqinfo(subject_folder, pool=None):
+    """
+    Group the DICOMs of a sorted subject folder by series and return one SeqInfo per series,
+    ordered by series number. Only headers of new or changed files are read.
+    """
+    return seqinfo_from(group_series(subject_folder, pool))
+
+def series_problems(files, expected_volumes=None):
+    """
+    Check from the headers that the (path, header) files of one MR series are complete and belong together.
+    Returns a list of problems: missing instance numbers, instance numbers used by different images (mixed series),
+    several studies in one series, or an image count that is not a whole number of ImagesInAcquisition
+    or NumberOfTemporalPositions. Siemens mosaics hold several slices per image, so their image count is
+    checked as a number of volumes instead: it must match NumberOfTemporalPositions when the scanner writes it,
+    or else expected_volumes (the volumes of the longest other run of the same protocol, see incomplete_series)
+    """
+    headers = [header for _, header in files]
+    if headers[0]["modality"] != "MR":
+        return []
+    problems = []
+
+    studies = {header["study_uid"] for header in headers}
+    if len(studies) > 1:
+        problems.append(f"mixed series: files of {len(studies)} studies")
+
+    instances = {}
+    for header in headers:
+        instance_number = header_number(header["instance_number"])
+        if instance_number is not None:
+            instances.setdefault(instance_number, set()).add(header["sop_uid"])
+    mixed = sum(1 for sop_uids in instances.values() if len(sop_uids) > 1)
+    if mixed:
+        problems.append(f"mixed series: {mixed} instance number(s) used by different images")
+    if instances:
+        missing = max(instances) - min(instances) + 1 - len(instances)
+        if missing:
+            problems.append(f"{missing} missing instance(s) between {min(instances)} and {max(instances)}")
+
+    if is_mosaic(files):
+        n_volumes = len({header["sop_uid"] for header in headers})
+        temporal_positions = max((header_number(header["number_of_temporal_positions"]) or 0) for header in headers)
+        if temporal_positions and n_volumes != temporal_positions:
+            problems.append(f"{n_volumes} volumes, NumberOfTemporalPositions is {temporal_positions}")
+        elif not temporal_positions and expected_volumes and n_volumes < expected_volumes:
+            problems.append(f"{n_volumes} volumes, another run of this protocol has {expected_volumes}")
+    else:
+        n_images = sum(header_number(header["number_of_frames"]) or 1 for header in headers)
+        for field, tag_name in [("images_in_acquisition", "ImagesInAcquisition"), ("number_of_temporal_positions", "NumberOfTemporalPositions")]:
+            expected = max((header_number(header[field]) or 0) for header in headers)
+            if expected and n_images % expected:
+                problems.append(f"{n_images} images, not a multiple of {tag_name} ({expected})")
+    return problems
+
+def evaluate_heuristic(module, seqinfo):
+    """Run the heuristic's infotodict and return {key: [series_id, ...]} for the keys that got series"""
+    info = module.infotodict(seqinfo)
+    plan = {}
+    for key, items in info.items():
+        series_ids = [item['item'] if isinstance(item, dict) else item for item in items]
+        if series_ids:
+            plan[key] = series_ids
+    return plan
+
+def mapped_series(module, seqinfo):
+    """Return the series_ids of seqinfo that the heuristic maps to a key"""
+    return {series_id for series_ids in evaluate_heuristic(module, seqinfo).values() for series_id in series_ids}
+
+def mapped_folders(module, subject_folder, pool=None):
+    """
+    Return the sorted sequence folders of a subject that hold at least one series mapped
+    to a key of the heuristic, or None if the heuristic cannot be evaluated on headers alone
+    """
+    seqinfo = build_seqinfo(subject_folder, pool)
+    try:
+        mapped = mapped_series(module, seqinfo)
+    except Exception as e:
+        print(f"WARNING: Heuristic could not be evaluated on the headers of {subject_folder} ({e}). All folders will be converted.")
+        return None
+    return sorted({s.dcm_dir_name for s in seqinfo if s.series_id in mapped})
+
+def incomplete_series(module, subject_folder, pool=None):
+    """
+    Return {series_id: [problems]} for the incomplete or mixed series of a sorted subject (see series_problems),
+    from the DICOM headers only. Only series mapped by the heuristic are checked, or all of them
+    if the heuristic cannot be evaluated on headers alone
+    """
+    series = group_series(subject_folder, pool)
+    seqinfo = seqinfo_from(series)
+    try:
+        plan = evaluate_heuristic(module, seqinfo)
+        mapped = {series_id for series_ids in plan.values() for series_id in series_ids}
+    except Exception:
+        mapped = {s.series_id for s in seqinfo}
+
+    # Runs of the same protocol (protocol name and series description, so that SBRef series are apart) are
+    # expected to have as many volumes: mosaics without NumberOfTemporalPositions are compared with the longest
+    runs = {}
+    for series_uid, files in series.items():
+        if is_mosaic(files):
+            run_key = (files[0][1]["protocol_name"], files[0][1]["series_description"])
+            runs[run_key] = max(runs.get(run_key, 0), len({header["sop_uid"] for _, header in files}))
+
+    incomplete = {}
+    for s in seqinfo:
+        if s.series_id in mapped:
+            files = series[s.series_uid]
+            problems = series_problems(files, runs.get((files[0][1]["protocol_name"], files[0][1]["series_description"])))
+            if problems:
+                incomplete[s.series_id] = problems
+    return incomplete
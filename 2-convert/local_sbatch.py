@@ -0,0 +1,80 @@
+############################################
+#######     LOCAL SBATCH STAND-IN     ######
+#######       BBSLab Oct 2025         ######
+############################################
+
+# Runs a SLURM array job script on this machine, one local process per array task, so the array mode of
+# DICOM_to_BIDS.py can be tested without a cluster. Only the options the pipeline uses are understood:
+# --array (e.g. 0-9%4, on the command line or in #SBATCH lines), -o/--output (with %A and %a) and --wait.
+# Other options (partition, time, cpus, ...) are ignored.
+#
+# Usage: python local_sbatch.py [--wait] [--array=<indices>] <job script>
+
+import os
+import sys
+import shlex
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+def parse_options(args):
+    """Parse the sbatch options the stand-in understands, ignoring any other"""
+    parser = argparse.ArgumentParser(prog="local_sbatch.py", add_help=False)
+    parser.add_argument("--array", "-a")
+    parser.add_argument("--output", "-o")
+    parser.add_argument("--wait", "-W", action="store_true")
+    return parser.parse_known_args(args)[0]
+
+def script_options(job_script):
+    """Return the options of the #SBATCH lines of a job script"""
+    args = []
+    with open(job_script, "r") as f:
+        for line in f:
+            if line.startswith("#SBATCH"):
+                args.extend(shlex.split(line[len("#SBATCH"):]))
+    return parse_options(args)
+
+def array_indices(array):
+    """Return (task ids, maximum of concurrent tasks) of an --array value such as 0-9%4 or 1,3,5"""
+    array, _, max_tasks = array.partition("%")
+    task_ids = []
+    for part in array.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            step = 1
+            if ":" in last:
+                last, step = last.split(":")
+            task_ids.extend(range(int(first), int(last) + 1, int(step)))
+        else:
+            task_ids.append(int(part))
+    return task_ids, int(max_tasks) if max_tasks else os.cpu_count()
+
+def run_task(job_script, job_id, task_id, output):
+    """Run one array task of the job script, as SLURM would, and return its exit code"""
+    env = dict(os.environ, SLURM_JOB_ID=str(job_id), SLURM_ARRAY_JOB_ID=str(job_id), SLURM_ARRAY_TASK_ID=str(task_id))
+    output = output.replace("%A", str(job_id)).replace("%a", str(task_id)).replace("%j", str(job_id))
+    with open(output, "w") as log:
+        return subprocess.run(["bash", job_script], env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python local_sbatch.py [--wait] [--array=<indices>] <job script>")
+        return 1
+    job_script = sys.argv[-1]
+    options = script_options(job_script)
+    command_line = parse_options(sys.argv[1:-1])
+    array = command_line.array or options.array or "0"
+    output = command_line.output or options.output or "slurm-%A_%a.out"
+
+    # The process id stands in for the job id
+    job_id = os.getpid()
+    task_ids, max_tasks = array_indices(array)
+    print(f"Submitted batch job {job_id}", flush=True)
+
+    # Like sbatch --wait, the exit code is the highest exit code of the array tasks
+    with ThreadPoolExecutor(max_workers=max_tasks) as pool:
+        exit_codes = list(pool.map(lambda task_id: run_task(job_script, job_id, task_id, output), task_ids))
+    return max(exit_codes)
+
+if __name__ == '__main__':
+    sys.exit(main())
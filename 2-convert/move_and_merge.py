@@ -5,43 +5,278 @@
 
 import os
 import sys
+import json
+import shutil
+import time
+import socket
+import hashlib
+import threading
 import warnings
-from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
 root_dir = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(root_dir)
 from meta import meta_func, meta_create
+from nifti_compress import compress_recorded
 
 # we have to move the generated BIDS and metadata to the shared folder
 meta_create()
 local_bids_path = meta_func("bids_out", "your BIDS source (local) directory path")
 destination_bids_path = meta_func("bids_in", "your BIDS destination (shared) directory path")
 
-#subjects to move
-list_of_subs_local = [sub for sub in os.listdir(local_bids_path) if sub[:4] == "sub-"]
+# Number of files copied at the same time when the local and shared BIDS folders are on different filesystems
+# (on the same filesystem, folders are moved with a rename and nothing is copied)
+n_transfer_workers = 8
+
+# Compare SHA-256 checksums, not only size and modification time: every copy is verified before its local file is
+# deleted, and a file already in the shared folder counts as transferred only if it has the checksum of the local one
+verify_checksum = True
+
+# The shared participants.tsv, .bidsignore and error_heudiconv.txt are locked while they are merged, so several
+# workstations can move data at the same time. A lock older than this (in seconds) was left by a crashed run and is removed
+stale_lock_age = 300
+
+# Gzip (in parallel blocks, see nifti_compress.py) the .nii files that DICOM_to_BIDS.py wrote uncompressed with
+# compression = "background" and did not compress yet (e.g. its run was interrupted) before they are moved.
+# Only the files recorded by that mode are gzipped: .nii outputs requested by a heuristic are left as they are
+compress_nifti = True
+
+# Files copied and verified so far, so an interrupted move resumes where it stopped. It is saved every
+# manifest_save_files changed entries or manifest_save_interval seconds, and at the end of the run
+# (files copied after the last save are found up to date by their checksum on the next run)
+manifest_path = os.path.join(local_bids_path, ".mright", "transfer_manifest.json")
+manifest_save_files = 200
+manifest_save_interval = 10
+manifest_lock = threading.Lock()
+manifest_changes = 0
+manifest_saved = time.monotonic()
+
+# function: load the transfer manifest
+def manifest_load():
+    '''This function returns the transfer manifest: {destination file (relative to the shared BIDS folder):
+    {size, mtime_ns, sha256}} of the files copied and verified by previous runs, whose local copy was not deleted yet'''
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    return {}
+
+# function: save the transfer manifest
+def manifest_save(manifest, changes=0):
+    '''This function saves the transfer manifest atomically (temporary file + rename). Given the number of entries
+    just changed, it only saves once manifest_save_files changes or manifest_save_interval seconds have piled up'''
+    global manifest_changes, manifest_saved
+    with manifest_lock:
+        manifest_changes += changes
+        if changes and manifest_changes < manifest_save_files and time.monotonic() - manifest_saved < manifest_save_interval:
+            return
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        manifest_changes = 0
+        manifest_saved = time.monotonic()
+
+# function: forget transferred files
+def manifest_drop(manifest, destinations):
+    '''This function removes the given destination files from the transfer manifest, once their local copy was deleted'''
+    with manifest_lock:
+        for destination in destinations:
+            manifest.pop(os.path.relpath(destination, destination_bids_path), None)
+    manifest_save(manifest, len(destinations))
+
+# function: checksum of a file
+def file_hash(path):
+    '''This function returns the SHA-256 checksum of a file'''
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# function: compare file size and modification time
+def same_state(stat1, stat2):
+    '''This function returns True if two os.stat results have the same size and modification time
+    (within one second, as network filesystems may store coarser times)'''
+    return stat1.st_size == stat2.st_size and abs(stat1.st_mtime_ns - stat2.st_mtime_ns) <= 1e9
+
+# function: check whether a move can be a rename
+def same_filesystem(source, destination_folder):
+    '''This function returns True if source can be renamed into destination_folder (same device)'''
+    return os.stat(source).st_dev == os.stat(destination_folder).st_dev
+
+# function: copy a file without reading it into Python
+def copy_file(source, destination):
+    '''This function copies a file inside the kernel with copy_file_range (falling back to
+    shutil.copyfile, which uses sendfile) and copies its permissions and modification time'''
+    try:
+        with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    except (AttributeError, OSError):
+        shutil.copyfile(source, destination)
+    shutil.copystat(source, destination)
+
+# function: transfer one file to the shared folder
+def sync_file(source, destination, manifest, exists=True):
+    '''This function brings destination up to date with source, like rsync, and returns "moved", "copied", "up to date" or "conflict".
+    exists is False when the destination folder did not exist, so the destination file is not looked up.
+    A destination file that differs from source is only replaced if the manifest shows that a previous run copied it
+    (and it was not changed since); otherwise it is a conflict and is left untouched. With rename_folders (same filesystem), the file
+    is moved with an atomic rename. Otherwise it is copied to a temporary file, verified (size, and checksum with verify_checksum)
+    and renamed, so the destination never holds a partial file. Copied and up-to-date files are recorded in the manifest'''
+    key = os.path.relpath(destination, destination_bids_path)
+    source_stat = os.stat(source)
+    if exists and os.path.exists(destination):
+        destination_stat = os.stat(destination)
+        entry = manifest.get(key)
+        ours = entry is not None and (entry["size"], entry["mtime_ns"]) == (destination_stat.st_size, destination_stat.st_mtime_ns)
+        if same_state(source_stat, destination_stat):
+            if ours or not verify_checksum or file_hash(source) == file_hash(destination):
+                with manifest_lock:
+                    manifest[key] = {"size": destination_stat.st_size, "mtime_ns": destination_stat.st_mtime_ns,
+                                     "sha256": entry["sha256"] if ours else None}
+                return "up to date"
+        if not ours:
+            return "conflict"
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+    if rename_folders:
+        os.replace(source, destination)
+        return "moved"
+
+    partial = os.path.join(os.path.dirname(destination), "." + os.path.basename(destination) + ".part")
+    if os.path.lexists(partial):
+        os.remove(partial)  # leftover of an interrupted copy
+    copy_file(source, partial)
+    checksum = file_hash(source) if verify_checksum else None
+    partial_stat = os.stat(partial)
+    if partial_stat.st_size != source_stat.st_size or (verify_checksum and file_hash(partial) != checksum):
+        os.remove(partial)
+        raise OSError("the copy of {} could not be verified".format(source))
+    os.replace(partial, destination)
+    with manifest_lock:
+        manifest[key] = {"size": partial_stat.st_size, "mtime_ns": partial_stat.st_mtime_ns, "sha256": checksum}
+    manifest_save(manifest, 1)
+    return "copied"
+
+# function: transfer a folder to the shared folder
+def sync_folder(source, destination, exists, manifest, pool):
+    '''This function transfers every file of the source folder to the destination folder (see sync_file), n_transfer_workers
+    files at a time, and removes the source folder once the manifest confirms that all its files arrived.
+    On the same filesystem, a folder missing at the destination (exists is False) is moved with a single rename.
+    Returns True if the source folder was removed'''
+    if rename_folders and not exists:
+        os.rename(source, destination)
+        return True
+
+    files = []
+    for dirpath, _, filenames in os.walk(source):
+        os.makedirs(os.path.join(destination, os.path.relpath(dirpath, source)), exist_ok=True)
+        files.extend(os.path.relpath(os.path.join(dirpath, filename), source) for filename in filenames)
+
+    def transfer(file):
+        try:
+            return sync_file(os.path.join(source, file), os.path.join(destination, file), manifest, exists)
+        except OSError as e:
+            warnings.warn('WARNING: {} could not be transferred: {}'.format(os.path.join(source, file), e))
+            return "failed"
+    results = list(pool.map(transfer, files) if pool is not None else map(transfer, files))
+
+    conflicts = [file for file, result in zip(files, results) if result == "conflict"]
+    if conflicts:
+        warnings.warn('WARNING: {} file(s) of {} differ from the files already in {} and were SKIPPED: {}'.format(
+                      len(conflicts), source, destination, ", ".join(conflicts)))
+    if any(result in ["conflict", "failed"] for result in results):
+        return False
+
+    # Everything arrived: the local copy and its manifest entries are no longer needed
+    shutil.rmtree(source)
+    manifest_drop(manifest, [os.path.join(destination, file) for file in files])
+    return True
 
 # function: move subject-related files to shared folder
-def move_subs_to_destination(source, destination):
+def move_subs_to_destination(source, destination, source_entries, destination_entries, manifest, pool):
     '''This function moves the subfolders of a given subject to the
-    destination folder'''
-    if os.path.isdir(source):
-        if os.path.isdir(destination) == False:
+    destination folder. source_entries and destination_entries are the names
+    in both subject folders, from the start-up scan (None if the folder does not exist).
+    Returns False if some files could not be moved'''
+    moved = True
+    if source_entries is not None:
+        if destination_entries is None:
             os.mkdir(destination)
-        if os.listdir(source) == []:
+            destination_entries = set()
+        if source_entries == set():
             warnings.warn('WARNING: Source subject folder {} is empty. Check if it has not been already moved'.format(source))
-        for subdir in os.listdir(source):
-            if (subdir in os.listdir(destination)) == False:
-                command_dir = "cp -r " + os.path.join(source, subdir) + " " + os.path.join(destination, subdir) + " && rm -rf " + os.path.join(source, subdir)
-                os.system(command_dir)
+        for subdir in sorted(source_entries):
+            if os.path.isdir(os.path.join(source, subdir)) == False:
+                result = sync_file(os.path.join(source, subdir), os.path.join(destination, subdir), manifest, subdir in destination_entries)
+                if result != "conflict":
+                    if result != "moved":
+                        os.remove(os.path.join(source, subdir))
+                        manifest_drop(manifest, [os.path.join(destination, subdir)])
+                    print('{} file was SUCCESSFULLY MOVED to {}'.format(subdir, destination))
+                else:
+                    warnings.warn('WARNING: File {} differs from the file already in subject folder {}. Moving was SKIPPED.'.format(subdir, destination))
+                    moved = False
+            elif sync_folder(os.path.join(source, subdir), os.path.join(destination, subdir), subdir in destination_entries, manifest, pool):
                 print('{} subfolder was SUCCESSFULLY MOVED to {}'.format(subdir, destination))
             else:
-                warnings.warn('WARNING: Subfolder {} already exists in subject folder {}. Moving was SKIPPED.'.format(subdir, destination))
+                warnings.warn('WARNING: Subfolder {} was only partly moved to {}. Its local copy was kept; run the script again to resume.'.format(subdir, destination))
+                moved = False
     else:
         warnings.warn('WARNING: Source subject folder {} does not exist. Check if it has not been already moved, or if the subject really exists.'.format(source))
+    return moved
+
+# function: list a BIDS root once
+def scan_bids(bids_root):
+    '''This function lists a BIDS root once and returns the names of its top-level entries and,
+    for every subject folder, the names of its subfolders and files: (set, {sub-X: set})'''
+    top = set()
+    subjects = {}
+    with os.scandir(bids_root) as entries:
+        for entry in entries:
+            top.add(entry.name)
+            if entry.name[:4] == "sub-" and entry.is_dir():
+                subjects[entry.name] = set(os.listdir(entry.path))
+    return top, subjects
+
+# function: list the .heudiconv folders of some subjects
+def scan_heudiconv(bids_root, subjects):
+    '''This function returns {subject: set of subfolder names} for the given subjects that have a .heudiconv/<subject> folder'''
+    heudiconv_path = os.path.join(bids_root, '.heudiconv')
+    if not os.path.isdir(heudiconv_path):
+        return {}
+    with os.scandir(heudiconv_path) as entries:
+        return {entry.name: set(os.listdir(entry.path)) for entry in entries if entry.name in subjects and entry.is_dir()}
+
+# only .nii.gz files go to the shared folder
+if compress_nifti:
+    with ThreadPoolExecutor(max_workers=n_transfer_workers) as compress_pool:
+        n_compressed = compress_recorded(local_bids_path, compress_pool)
+    if n_compressed:
+        print("{} uncompressed NIfTI file(s) were gzipped before moving".format(n_compressed))
+
+# scan each BIDS root once: the checks and existence tests below use these in-memory sets, not the (shared) filesystem
+local_top, local_subjects = scan_bids(local_bids_path)
+destination_top, destination_subjects = scan_bids(destination_bids_path)
+bids_scans = {local_bids_path: local_subjects, destination_bids_path: destination_subjects}
+
+#subjects to move
+list_of_subs_local = sorted(local_subjects)
+local_heudiconv = scan_heudiconv(local_bids_path, {sub[4:] for sub in list_of_subs_local})
+destination_heudiconv = scan_heudiconv(destination_bids_path, {sub[4:] for sub in list_of_subs_local})
+
+# folders are renamed, not copied, when both BIDS roots are on the same filesystem
+rename_folders = same_filesystem(local_bids_path, destination_bids_path)
 
 # ses-noses tree check
-listdir2 = lambda bids_root:[os.path.basename(str(subdir_p)) for subdir_p in list(Path(bids_root).glob(os.path.join('sub-*','*')))]
+listdir2 = lambda bids_root: [name for names in bids_scans[bids_root].values() for name in names]
 ses_tree = lambda bids_root: any('ses' in subdir_n for subdir_n in listdir2(bids_root))
 noses_tree = lambda bids_root: any('ses' not in subdir_n for subdir_n in listdir2(bids_root))
 
@@ -58,62 +293,190 @@ check(destination_bids_path, destination_bids_path)
 check(local_bids_path, destination_bids_path)
 
 # create .heudiconv in destination path
-if '.heudiconv' not in os.listdir(destination_bids_path):
+if '.heudiconv' not in destination_top:
     os.mkdir(os.path.join(destination_bids_path, '.heudiconv'))
    
-for sub in list_of_subs_local:
-    # move BIDS
-    move_subs_to_destination(os.path.join(local_bids_path, sub), os.path.join(destination_bids_path, sub))
-    # move .heudiconv
-    move_subs_to_destination(os.path.join(local_bids_path, '.heudiconv', sub[4:]), os.path.join(destination_bids_path, '.heudiconv', sub[4:]))
+manifest = manifest_load()
+all_moved = True
+with ThreadPoolExecutor(max_workers=n_transfer_workers) as transfer_pool:
+    for sub in list_of_subs_local:
+        # move BIDS
+        all_moved &= move_subs_to_destination(os.path.join(local_bids_path, sub), os.path.join(destination_bids_path, sub),
+                                              local_subjects.get(sub), destination_subjects.get(sub), manifest, transfer_pool)
+        # move .heudiconv
+        all_moved &= move_subs_to_destination(os.path.join(local_bids_path, '.heudiconv', sub[4:]), os.path.join(destination_bids_path, '.heudiconv', sub[4:]),
+                                              local_heudiconv.get(sub[4:]), destination_heudiconv.get(sub[4:]), manifest, transfer_pool)
     
 # move unique files: files that only exist once in each BIDS directory        
-others_local = [other for other in os.listdir(local_bids_path) if other[:4] != "sub-"]
-uniques_local = [unique for unique in others_local if (unique not in [".heudiconv", ".bidsignore", "participants.tsv", "error_heudiconv.txt"])] #.heudiconv folder and editable files are excluded
+others_local = [other for other in sorted(local_top) if other[:4] != "sub-"]
+uniques_local = [unique for unique in others_local if (unique not in [".heudiconv", ".mright", ".bidsignore", "participants.tsv", "error_heudiconv.txt"])] #.heudiconv folder, conversion logs and editable files are excluded
 
 for unique_file in uniques_local:
-    if (unique_file in os.listdir(destination_bids_path)) == False:
-        command_file = "cp " + os.path.join(local_bids_path, unique_file) + " " + os.path.join(destination_bids_path, unique_file) + " && rm -f " + os.path.join(local_bids_path, unique_file)
-        os.system(command_file)
+    if (unique_file in destination_top) == False:
+        if os.path.isdir(os.path.join(local_bids_path, unique_file)):
+            all_moved &= sync_folder(os.path.join(local_bids_path, unique_file), os.path.join(destination_bids_path, unique_file), False, manifest, None)
+        elif sync_file(os.path.join(local_bids_path, unique_file), os.path.join(destination_bids_path, unique_file), manifest, False) != "moved":
+            os.remove(os.path.join(local_bids_path, unique_file))
+            manifest_drop(manifest, [os.path.join(destination_bids_path, unique_file)])
         print('{} file was successfully moved to destination folder'.format(unique_file))
     else:
         print('INFO: {} file already exists in destination folder. Moving was SKIPPED.'.format(unique_file))
+
+# Last changes of the transfer manifest (saved in batches)
+manifest_save(manifest)
         
+# function: lock a shared file
+@contextmanager
+def shared_file_lock(file_path):
+    '''This function holds an advisory lock on a shared file while the with block runs: a .<file>.lock file
+    created exclusively (O_CREAT | O_EXCL works on network shares, where fcntl locks often do not).
+    Waits while another run holds the lock, and takes over locks older than stale_lock_age.
+    The lock is touched while it is held, so a long merge is never seen as stale'''
+    lock_path = os.path.join(os.path.dirname(file_path), "." + os.path.basename(file_path) + ".lock")
+    token = "{} {} {}\n".format(socket.gethostname(), os.getpid(), os.urandom(8).hex())
+    while True:
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                lock_stat = os.stat(lock_path)
+            except FileNotFoundError:
+                continue
+            if time.time() - lock_stat.st_mtime > stale_lock_age:
+                take_stale_lock(lock_path, lock_stat, token)
+                continue
+            time.sleep(0.5)
+    with os.fdopen(lock_fd, "w") as lock_file:
+        lock_file.write(token)
+
+    # Keep the lock fresh while it is held
+    released = threading.Event()
+    def refresh():
+        while not released.wait(stale_lock_age / 4):
+            try:
+                os.utime(lock_path)
+            except FileNotFoundError:
+                return
+    refresher = threading.Thread(target=refresh, daemon=True)
+    refresher.start()
+    try:
+        yield
+    finally:
+        released.set()
+        refresher.join()
+        # Only remove the lock if it is still ours
+        if read_lines(lock_path) == [token.rstrip("\n")]:
+            os.remove(lock_path)
+        else:
+            warnings.warn('WARNING: Lock {} was taken over by another run while it was held'.format(lock_path))
+
+# function: take over a stale lock
+def take_stale_lock(lock_path, lock_stat, token):
+    '''This function removes a stale lock without racing other waiters: the lock is first renamed to a name of
+    its own (only one waiter can rename it), then removed only if it is still the stale lock that was seen.
+    A fresh lock renamed by mistake (another waiter took over first) is put back'''
+    taken_path = lock_path + "." + token.split()[-1]
+    try:
+        os.rename(lock_path, taken_path)
+    except FileNotFoundError:
+        return
+    taken_stat = os.stat(taken_path)
+    if taken_stat.st_ino == lock_stat.st_ino and time.time() - taken_stat.st_mtime > stale_lock_age:
+        warnings.warn('WARNING: Removing stale lock {} ({})'.format(lock_path, " ".join(read_lines(taken_path))))
+    else:
+        try:
+            os.link(taken_path, lock_path)
+        except FileExistsError:
+            pass
+    os.remove(taken_path)
+
+# function: replace a file atomically
+def replace_file(file_path, lines):
+    '''This function writes the given lines to a temporary file and renames it over file_path, so that
+    the file is never seen half-written'''
+    temp_path = os.path.join(os.path.dirname(file_path), "." + os.path.basename(file_path) + ".tmp")
+    with open(temp_path, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+    os.replace(temp_path, file_path)
+
+# function: append lines to a shared file
+def append_lines(file_path, lines):
+    '''This function appends lines to the end of a text file (after a line ending, if its last line has none),
+    so only the new lines are written'''
+    with open(file_path, "ab+") as f:
+        f.seek(0, os.SEEK_END)
+        missing_newline = f.tell() > 0 and (f.seek(-1, os.SEEK_END), f.read(1))[1] != b"\n"
+        f.write((("\n" if missing_newline else "") + "".join(line + "\n" for line in lines)).encode())
+
+# function: read the lines of a text file
+def read_lines(file_path):
+    '''This function returns the lines of a text file without line endings (an empty list if it does not exist)'''
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path, "r") as f:
+        return f.read().splitlines()
+
 # merge editable text files
 def merge_files(source_file_path, destination_file_path):
+    '''This function appends to the shared destination file the lines of the source file it does not have yet'''
     if os.path.exists(source_file_path) == True:
-        with open(destination_file_path, "a") as dest:
-            pass
-        with open(destination_file_path, "r+") as dest:
-            dest_lines = [line.rstrip() for line in dest]
-            with open(source_file_path, 'r') as src:
-                for line in src:
-                    if line[:-1] not in dest_lines:
-                        dest.write(line)
-        with open(destination_file_path, "r") as dest2:                
-            dest_lines2 = [line.rstrip() for line in dest2]
-            if dest_lines != dest_lines2:
+        with shared_file_lock(destination_file_path):
+            dest_lines = read_lines(destination_file_path)
+            known_lines = {line.rstrip() for line in dest_lines}
+            new_lines = []
+            for line in read_lines(source_file_path):
+                if line.rstrip() not in known_lines:
+                    known_lines.add(line.rstrip())
+                    new_lines.append(line)
+            if new_lines:
+                append_lines(destination_file_path, new_lines)
                 print('{} was updated'.format(destination_file_path))
-                        
+
+# merge participants.tsv
+def merge_participants(source_file_path, destination_file_path):
+    '''This function appends to the shared participants.tsv the rows of the participants it does not have yet.
+    If the local file has other columns, both tables are merged with pandas and the file is replaced instead'''
+    if os.path.exists(source_file_path) == False:
+        return
+    with shared_file_lock(destination_file_path):
+        src_lines = [line for line in read_lines(source_file_path) if line.strip()]
+        dest_lines = [line for line in read_lines(destination_file_path) if line.strip()]
+        if len(src_lines) <= 1:
+            # Empty or header-only local file: no participants to add
+            return
+        if dest_lines == []:
+            replace_file(destination_file_path, src_lines)
+        elif src_lines[0].rstrip().split("\t") == dest_lines[0].rstrip().split("\t"):
+            # Same columns: append the rows of new participants
+            participants = {line.split("\t")[0] for line in dest_lines[1:]}
+            new_rows = []
+            for line in src_lines[1:]:
+                if line.split("\t")[0] not in participants:
+                    participants.add(line.split("\t")[0])
+                    new_rows.append(line)
+            if new_rows:
+                append_lines(destination_file_path, new_rows)
+                print("participants.tsv was successfully updated")
+        else:
+            # New or reordered columns: merge the tables with pandas dataframes
+            df_participants_src = pd.read_csv(source_file_path, sep='\t')
+            df_participants_des = pd.read_csv(destination_file_path, sep='\t')
+            new_participants_des = pd.concat((df_participants_des, df_participants_src)).groupby('participant_id').first().reset_index()
+            replace_file(destination_file_path, new_participants_des.to_csv(sep="\t", header=True, index=False, na_rep="n/a").splitlines())
+            if df_participants_des.equals(new_participants_des) == False:
+                print("participants.tsv was successfully updated")
+
 # merge .bidsignore and error_heudiconv.txt
 merge_files(os.path.join(local_bids_path,'.bidsignore'), os.path.join(destination_bids_path,'.bidsignore'))
 merge_files(os.path.join(local_bids_path,'error_heudiconv.txt'), os.path.join(destination_bids_path,'error_heudiconv.txt'))
 
-# merge participants.tsv using pandas dataframes
-df_participants_src = pd.read_csv(os.path.join(local_bids_path,"participants.tsv"), sep='\t')
+# merge participants.tsv
+merge_participants(os.path.join(local_bids_path,"participants.tsv"), os.path.join(destination_bids_path,"participants.tsv"))
 
-if os.path.exists(os.path.join(destination_bids_path,"participants.tsv")) == True:   
-    df_participants_des = pd.read_csv(os.path.join(destination_bids_path,"participants.tsv"), sep='\t')
-    new_participants_des = pd.concat((df_participants_des, df_participants_src)).groupby('participant_id').first().reset_index() 
-    new_participants_des.to_csv(os.path.join(destination_bids_path,"participants.tsv"), sep="\t",
-                      header=True, index=False, na_rep="n/a")
-    if df_participants_des.equals(new_participants_des) == False:
-        print("participants.tsv was successfully updated")
+# remove local_bids_path tree, unless some files could not be moved
+if all_moved:
+    os.system(f"rm -rf {local_bids_path}/*")
+    print(local_bids_path + " local BIDS directory was successfully removed")
 else:
-    new_participants_des = df_participants_src
-    new_participants_des.to_csv(os.path.join(destination_bids_path,"participants.tsv"), sep="\t",
-                      header=True, index=False, na_rep="n/a")
-
-# remove local_bids_path tree
-os.system(f"rm -rf {local_bids_path}/*")
-print(local_bids_path + " local BIDS directory was successfully removed")
\ No newline at end of file
+    warnings.warn('WARNING: Some files were not moved (see warnings above). {} local BIDS directory was kept; run the script again to resume.'.format(local_bids_path))
\ No newline at end of file
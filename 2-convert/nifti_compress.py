@@ -0,0 +1,178 @@
+############################################
+#######   PARALLEL NIFTI COMPRESSION  ######
+#######       BBSLab Oct 2025         ######
+############################################
+
+# Gzips the uncompressed .nii files of a BIDS folder the way pigz does: each file is cut into blocks that are
+# deflated by several threads at once (zlib releases the GIL), each block primed with the last 32 KB of the previous one,
+# and the blocks are joined into one standard gzip stream, readable by gunzip, nibabel, FSL, ... The scans.tsv rows
+# and fieldmap IntendedFor entries naming the compressed files are renamed to .nii.gz.
+#
+# The dcm2niix engine records the .nii files it writes uncompressed (DICOM_to_BIDS.py compression = "background")
+# in <BIDS folder>/.mright/uncompressed/, so DICOM_to_BIDS.py and move_and_merge.py (compress_nifti) only gzip those,
+# never the .nii files a heuristic asked for. On its own, the script gzips every .nii of a BIDS folder:
+#   python nifti_compress.py <BIDS folder> [<number of threads>]
+
+import os
+import sys
+import zlib
+import json
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from heudiconv.utils import update_json
+
+# Uncompressed bytes per block, and gzip compression level (6, as gzip, pigz and dcm2niix)
+block_size = 1024 * 1024
+compress_level = 6
+
+# Size of the deflate window: each block may refer to the last 32 KB of the previous one
+window_size = 32 * 1024
+
+# Blocks compressed ahead of the one being written, per file (bounds the memory used to block_size times this)
+max_pending_blocks = 32
+
+def compress_block(block, dictionary, last):
+    """Deflate one block (raw deflate), primed with dictionary. The last block ends the stream; the others end byte-aligned"""
+    if dictionary:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def gzip_file(nii_path, pool):
+    """
+    Compress nii_path into nii_path.gz with the threads of pool, then delete nii_path.
+    The .gz file is written under a temporary name and keeps the permissions and modification time of the .nii.
+    Returns the path of the .gz file
+    """
+    gz_path = nii_path + ".gz"
+    temp_path = os.path.join(os.path.dirname(gz_path), "." + os.path.basename(gz_path) + ".tmp")
+    stat = os.stat(nii_path)
+    crc = size = 0
+    pending = deque()
+    with open(nii_path, "rb") as source, open(temp_path, "wb") as destination:
+        # gzip header: deflate, no flags, modification time, no extra flags, Unix
+        destination.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(stat.st_mtime) & 0xffffffff) + b"\x00\x03")
+        previous = b""
+        block = source.read(block_size)
+        while True:
+            next_block = source.read(block_size)
+            last = not next_block
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            pending.append(pool.submit(compress_block, block, previous[-window_size:], last))
+            previous = block
+            # Write the blocks in order
+            while pending and (last or len(pending) > max_pending_blocks):
+                destination.write(pending.popleft().result())
+            if last:
+                break
+            block = next_block
+        destination.write(struct.pack("<II", crc & 0xffffffff, size & 0xffffffff))
+    os.chmod(temp_path, stat.st_mode & 0o7777)
+    os.utime(temp_path, (stat.st_atime, stat.st_mtime))
+    os.replace(temp_path, gz_path)
+    os.remove(nii_path)
+    return gz_path
+
+def rename_references(tsv_files, json_files, compressed):
+    """Rename the compressed .nii files (basenames in compressed) to .nii.gz in the filename column of scans.tsv files and in IntendedFor"""
+    renamed = lambda name: name + ".gz" if name.endswith(".nii") and os.path.basename(name) in compressed else name
+
+    for tsv_file in tsv_files:
+        with open(tsv_file, "r") as f:
+            lines = f.read().splitlines()
+        new_lines = [lines[0]] + ["\t".join([renamed(line.split("\t")[0])] + line.split("\t")[1:]) for line in lines[1:]]
+        if new_lines != lines:
+            mode = os.stat(tsv_file).st_mode & 0o7777
+            os.chmod(tsv_file, mode | 0o200)
+            with open(tsv_file, "w") as f:
+                f.write("\n".join(new_lines) + "\n")
+            os.chmod(tsv_file, mode)
+
+    for json_file in json_files:
+        with open(json_file, "r") as f:
+            intended_for = json.load(f).get("IntendedFor")
+        if not intended_for:
+            continue
+        new_intended_for = renamed(intended_for) if isinstance(intended_for, str) else [renamed(name) for name in intended_for]
+        if new_intended_for != intended_for:
+            # Written as heudiconv's populate_intended_for does
+            mode = os.stat(json_file).st_mode & 0o7777
+            update_json(json_file, {"IntendedFor": new_intended_for})
+            os.chmod(json_file, mode)
+
+def compress_bids(folder, pool, only=None):
+    """
+    Gzip every .nii under folder (a BIDS folder, or one of its subject[/session] folders), or only those in
+    the set of paths only, and rename them in its scans.tsv files and fieldmap IntendedFor.
+    Hidden folders (.heudiconv, .mright, ...) are skipped. Returns the number of files compressed
+    """
+    nii_files = []
+    tsv_files = []
+    json_files = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(".")]
+        for filename in filenames:
+            if filename.endswith(".nii") and not filename.startswith("."):
+                if only is None or os.path.join(dirpath, filename) in only:
+                    nii_files.append(os.path.join(dirpath, filename))
+            elif filename.endswith("_scans.tsv"):
+                tsv_files.append(os.path.join(dirpath, filename))
+            elif filename.endswith(".json") and os.path.basename(dirpath) == "fmap":
+                json_files.append(os.path.join(dirpath, filename))
+
+    compressed = set()
+    for nii_file in sorted(nii_files):
+        gzip_file(nii_file, pool)
+        compressed.add(os.path.basename(nii_file))
+    if compressed:
+        rename_references(tsv_files, json_files, compressed)
+    return len(compressed)
+
+def record_path(bids_root, folder):
+    """Return the record of the uncompressed files of a subject[/session] folder (e.g. sub-01/ses-02) of bids_root"""
+    return os.path.join(bids_root, ".mright", "uncompressed", folder.replace("/", "_") + ".json")
+
+def record_uncompressed(bids_root, folder, nii_files):
+    """Record the .nii files written uncompressed for the subject[/session] folder of bids_root, to be gzipped later"""
+    path = record_path(bids_root, folder)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"folder": folder, "files": sorted(os.path.relpath(nii_file, bids_root) for nii_file in nii_files)}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def compress_recorded(bids_root, pool, folder=None):
+    """
+    Gzip the recorded uncompressed .nii files of bids_root (only those of the subject[/session] folder if given),
+    rename them in scans.tsv and IntendedFor, and delete their records. Returns the number of files compressed
+    """
+    records_folder = os.path.join(bids_root, ".mright", "uncompressed")
+    if folder is not None:
+        record_files = [record_path(bids_root, folder)]
+    elif os.path.isdir(records_folder):
+        record_files = sorted(os.path.join(records_folder, name) for name in os.listdir(records_folder) if name.endswith(".json"))
+    else:
+        record_files = []
+
+    n_files = 0
+    for record_file in record_files:
+        if not os.path.isfile(record_file):
+            continue
+        with open(record_file, "r") as f:
+            record = json.load(f)
+        only = {os.path.join(bids_root, nii_file) for nii_file in record["files"]}
+        subject_folder = os.path.join(bids_root, record["folder"])
+        if os.path.isdir(subject_folder):
+            n_files += compress_bids(subject_folder, pool, only)
+        os.remove(record_file)
+    return n_files
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python nifti_compress.py <BIDS folder> [<number of threads>]")
+        sys.exit(1)
+    with ThreadPoolExecutor(max_workers=int(sys.argv[2]) if len(sys.argv) == 3 else os.cpu_count()) as pool:
+        n_files = compress_bids(sys.argv[1], pool)
+    print(f"{n_files} NIfTI file(s) compressed")
@@ -0,0 +1,76 @@
+############################################
+#######  HEURISTIC DRY-RUN PREVIEW   #######
+#######      BBSLab Oct 2025         #######
+############################################
+
+# Prints the BIDS files heudiconv would write for each sorted subject, by evaluating
+# the heuristic on seqinfo built from the DICOM headers. Nothing is converted.
+
+import os
+import sys
+import re
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from heuristic_plan import build_seqinfo, evaluate_heuristic
+
+# Number of concurrent header reads
+n_workers = 8
+
+def planned_files(key, series_ids, subj_clean, session):
+    """Return (series_id, BIDS file) pairs for one heuristic key, numbered like heudiconv's {item}"""
+    template, outtypes, _ = key
+    files = []
+    for item, series_id in enumerate(series_ids, 1):
+        prefix = template.format(subject=subj_clean, session=session, item=item, seqitem=item, subindex=1,
+                                 bids_subject_session_prefix="sub-" + subj_clean + ("_" + session if session else ""),
+                                 bids_subject_session_dir="sub-" + subj_clean + ("/" + session if session else ""))
+        files.append((series_id, ", ".join(prefix + "." + outtype for outtype in outtypes)))
+    return files
+
+def main():
+    # Import meta functions
+    root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    sys.path.append(root_dir)
+    from meta import meta_func, meta_create
+
+    # Input paths
+    meta_create()
+    dicoms_path = meta_func("dicom", "the path to the DICOMs folder")  # Path to DICOM directories
+    timepoint = meta_func("timepoint", "the name of the timepoint folder (e.g., 'TP2')") # Name of timepoint folder
+    heuristic_file_path = meta_func("heuristic", "your heuristic file path") # Path to heuristic file
+
+    # Same session label as DICOM_to_BIDS.py
+    ses = ''.join(filter(str.isdigit, timepoint)).zfill(2)
+    session = "ses-{}".format(ses) if ses != "NOSESSION" else None
+
+    # Dynamically load and execute a heuristic module
+    heuristic_module_name = os.path.basename(heuristic_file_path).split('.')[0]
+    spec = importlib.util.spec_from_file_location(heuristic_module_name, heuristic_file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    timepoint_folder = os.path.join(dicoms_path, timepoint)
+    subjects = sorted(name for name in os.listdir(timepoint_folder) if os.path.isdir(os.path.join(timepoint_folder, name)))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for subj in subjects:
+            subj_clean = re.sub(r'[^a-zA-Z0-9]', '', subj)
+            seqinfo = build_seqinfo(os.path.join(timepoint_folder, subj), pool)
+            print(f"\nsub-{subj_clean} ({len(seqinfo)} series)")
+            try:
+                plan = evaluate_heuristic(module, seqinfo)
+            except Exception as e:
+                print(f"  WARNING: the heuristic failed on this subject: {e!r}")
+                continue
+
+            bids_files = {}
+            for key, series_ids in plan.items():
+                for series_id, bids_file in planned_files(key, series_ids, subj_clean, session):
+                    bids_files.setdefault(series_id, []).append(bids_file)
+
+            for s in seqinfo:
+                for bids_file in bids_files.get(s.series_id, ["(not converted)"]):
+                    print(f"  {s.series_id:<40} {s.dcm_dir_name:<12} {s.series_files:>5} files -> {bids_file}")
+
+if __name__ == '__main__':
+    main()
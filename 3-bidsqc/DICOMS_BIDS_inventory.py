@@ -18,6 +18,7 @@ import os
 import datetime
 import csv
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 root_dir = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(root_dir)
@@ -43,47 +44,70 @@ else:
 today = str(datetime.date.today())
 output_path = os.path.join(qc_folder, seslabel, seslabel_dash+'dicoms_bids_inventory_'+today+'.csv')
 
-# list of subs for each path
-bids_ls = os.listdir(bids_path)
-bids = [sub for sub in bids_ls if "sub-" in sub and os.path.isdir(os.path.join(bids_path, sub, seslabel))]   # subs that have bids for this session
+# Number of directories listed at the same time. On network shares every listing waits for a round trip,
+# so several threads overlap them across roots and subjects. 1 = serial scan. The CSV is the same either way
+n_workers = 16
+pool = ThreadPoolExecutor(max_workers=n_workers)
+
+# BIDS types inventoried in each BIDS session folder
+bidstypes = ['anat', 'func', 'dwi', 'perf', 'fmap', 'swi']
+
+# scanning functions: each directory is listed once
+def scan_folder(path):
+    '''This function lists a folder once and returns {name: True for directories, False for the rest},
+    or None if the folder does not exist'''
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry.is_dir() for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def scan_bids_session(sub):
+    '''This function lists the BIDS session folder of a subject and each of its BIDS type folders once,
+    and returns {bidstype: file names}, or None if the subject has no BIDS folder for this session'''
+    entries = scan_folder(os.path.join(bids_path, sub, seslabel))
+    if entries is None:
+        return None
+    return {bidstype: os.listdir(os.path.join(bids_path, sub, seslabel, bidstype)) for bidstype in bidstypes if entries.get(bidstype)}
+
+def preprocessed_bold(sub):
+    '''This function returns (MNI space image exists, native space image exists) for a subject of the BOLD preprocessed directory'''
+    func_path = os.path.join(processed_path, sub, seslabel, 'func')
+    return (os.path.isfile(os.path.join(func_path, 'MNI_2mm', sub+'_'+seslabel_dash+"task-rest_dir-ap_run-{item:02d}_bold_MNI-space.nii.gz")),
+            os.path.isfile(os.path.join(func_path, 'native_T1', sub+'_'+seslabel_dash+"task-rest_dir-ap_run-{item:02d}_bold_T1-space.nii.gz")))
+
+# list of subs for each path (the four roots are listed at the same time)
+bids_ls, dicoms_ls, recons_ls, processed_ls = pool.map(os.listdir, [bids_path, dicoms_path, recons_path, processed_path])
+
+bids_subs = [sub for sub in bids_ls if "sub-" in sub]
+bids_sessions = dict(zip(bids_subs, pool.map(scan_bids_session, bids_subs)))
+bids = [sub for sub in bids_subs if bids_sessions[sub] is not None]   # subs that have bids for this session
 
-dicoms_ls = os.listdir(dicoms_path)
 dicoms = ["sub-" + sub for sub in dicoms_ls if (not sub in ["._.DS_Store", ".DS_Store"])]    # subs that have dicoms of this session
 
-recons_ls = os.listdir(recons_path)
 recons = [sub for sub in recons_ls if (not sub in ["._.DS_Store", ".DS_Store"] and (not "_" in sub) and "sub-" in sub and seslabel in sub)] # if session exists
 
-processed_ls = os.listdir(processed_path)
-mni    = [sub for sub in processed_ls if os.path.isfile(os.path.join(processed_path, sub, seslabel, 'func', 'MNI_2mm', sub+'_'+seslabel_dash+"task-rest_dir-ap_run-{item:02d}_bold_MNI-space.nii.gz"))] 
-native = [sub for sub in processed_ls if os.path.isfile(os.path.join(processed_path, sub, seslabel, 'func', 'native_T1', sub+'_'+seslabel_dash+"task-rest_dir-ap_run-{item:02d}_bold_T1-space.nii.gz"))] 
+processed = list(zip(processed_ls, pool.map(preprocessed_bold, processed_ls)))
+mni    = [sub for sub, (mni_found, _) in processed if mni_found]
+native = [sub for sub, (_, native_found) in processed if native_found]
 
 # check if MNI == Native
-mni_notnative = list(set(mni).difference(set(native)))
-native_notmni = list(set(native).difference(set(mni)))
+mni_notnative = sorted(set(mni).difference(set(native)))
+native_notmni = sorted(set(native).difference(set(mni)))
 if len(mni_notnative) != 0:
     print('WARNING: Subjects {} have preprocessed images in MNI space but not in the native one. These images will be omitted.'.format(mni_notnative))
 elif len(native_notmni) != 0:
     print('WARNING: Subjects {} have preprocessed images in the native space but not in the MNI one. These images will be omitted.'.format(native_notmni))
 
 # check if all subjects have DICOMS and BIDS
-all_subjects = list(set(dicoms).union(set(bids), set(recons), set(mni), set(native)))
-notbids = list(set(all_subjects).difference(set(bids)))
-notdicoms = list(set(all_subjects).difference(set(dicoms)))
+all_subjects = sorted(set(dicoms).union(set(bids), set(recons), set(mni), set(native)))
+notbids = sorted(set(all_subjects).difference(set(bids)))
+notdicoms = sorted(set(all_subjects).difference(set(dicoms)))
 if len(notbids) > 0:
     print("WARNING: Subjects {} do not have BIDS images. Check if the conversion was done and the given path is correct".format(notbids))
 elif len(notdicoms) > 0:
     print("WARNING: Subjects {} do not have DICOM images. Check if the DICOMS were not removed and the given path is correct".format(notdicoms))
 
-# dictionary splits subs by bids type 
-subs_by_bidstype = {}
-bidstypes = ['anat', 'func', 'dwi', 'perf', 'fmap', 'swi']
-for bidstype in bidstypes:
-    subs_this_bidstype = [sub for sub in bids if os.path.isdir(os.path.join(bids_path, sub, seslabel, bidstype))]
-    subs_by_bidstype[bidstype] = subs_this_bidstype
-#subs_by_bidstype will be = {'anat': ['sub-1', 'sub-2',...],
-#                           'func':  ['sub-2', 'sub-4', 'sub-5',...],
-#                           ...}
-    
 # headers of the csv output
 header_list = ['id_user', 'Dicom', 'Dicom_resting', 'Dicom_T1', 'Dicom_T2', 'Dicom_pCASL',
                'Bids', 'Bids_func', 'Bids_func_bold', 'Bids_func_sbref',
@@ -98,15 +122,24 @@ header_list = ['id_user', 'Dicom', 'Dicom_resting', 'Dicom_T1', 'Dicom_T2', 'Dic
 bids_header_list = [bids_header for bids_header in header_list if 'Bids' in bids_header] # only bids-related headers
 
 # functions
-def simple_write(file, path):
-    '''This function writes 1 for non-empty existing directories,
-    and 0 for the rest'''
-    if os.path.isdir(path):
-        file.write("1,")
-        if len(os.listdir(path)) == 0:
-            print("WARNING: Folder {} is empty!!".format(path))
-    else:
-        file.write("0,")
+def folder_cells(path, warnings, subfolders=[]):
+    '''This function lists a folder once and returns its cell, 1 for existing directories and 0 for the rest,
+    followed by the cells of the given subfolders. Empty folders are added to warnings'''
+    entries = scan_folder(path)
+    if entries is None:
+        return ["0"] * (len(subfolders) + 1)
+    if len(entries) == 0:
+        warnings.append("WARNING: Folder {} is empty!!".format(path))
+    cells = ["1"]
+    for subfolder in subfolders:
+        if entries.get(subfolder):
+            cells.append("1")
+            with os.scandir(os.path.join(path, subfolder)) as subfolder_entries:
+                if next(subfolder_entries, None) is None:
+                    warnings.append("WARNING: Folder {} is empty!!".format(os.path.join(path, subfolder)))
+        else:
+            cells.append("0")
+    return cells
 
 # file substrings for each file type in each subdirectory        
 subdirs_dict = {'anat': ["T1", "T2", "FLAIR"],
@@ -116,24 +149,68 @@ subdirs_dict = {'anat': ["T1", "T2", "FLAIR"],
                 'perf': ["pcasl_dir-ap", "pcasl_dir-pa"],
                 'fmap': ["restsefm_dir-ap", "restsefm_dir-pa", "dwisefm_dir-ap", "dwisefm_dir-pa", "pcaslsefm_dir-ap", "pcaslsefm_dir-pa"]
                 }
-  
-def bids_write(file, bidstype):
-    '''Write 0 or 1 function for BIDS folder and subfolders'''
-    substring_list = subdirs_dict[bidstype]
-    if sub in subs_by_bidstype[bidstype]: #the sub has this BIDS type
-        file.write("1,")
-        bidstype_path = os.path.join(bids_path, sub, seslabel, bidstype)
-        if len(os.listdir(bidstype_path)) == 0:
-            print("WARNING: Folder {} is empty!!".format(bidstype_path))
-        files_this_bidstype = os.listdir(bidstype_path) # files in sub for this bids type
-        if bidstype == "dwi": #DWI files need 2 substrings for the detection
-            for two_substrings in substring_list:
-                file.write(str(int(sum([1 for file2 in files_this_bidstype if all(substring in file2 for substring in two_substrings)])))+",") # dwi files need 2 substring conditions
-        else:
-            for substring in substring_list:
-                file.write(str(int(sum([1 for file2 in files_this_bidstype if substring in file2])/2))+",")
+
+def file_counts(files, bidstype):
+    '''This function classifies the files of a BIDS type folder against all its substrings in one pass
+    and returns the number of files of each file type'''
+    # DWI files need 2 substrings for the detection
+    patterns = subdirs_dict[bidstype] if bidstype == "dwi" else [[substring] for substring in subdirs_dict[bidstype]]
+    counts = [0] * len(patterns)
+    for file in files:
+        for i, substrings in enumerate(patterns):
+            if all(substring in file for substring in substrings):
+                counts[i] += 1
+    if bidstype == "dwi":
+        return counts
+    return [int(count/2) for count in counts]   # images and their .json sidecars
+
+def bids_cells(sub, warnings):
+    '''This function returns the BIDS cells of a subject: 1 if it has a BIDS folder for this session and,
+    for each BIDS type, 1 and the number of files of each file type (or 0s if the subject does not have it)'''
+    if bids_sessions.get(sub) is None:
+        return ["0"] * len(bids_header_list)
+    cells = ["1"]
+    for bidstype in ['func', 'anat', 'swi', 'dwi', 'perf', 'fmap']:
+        files = bids_sessions[sub].get(bidstype)
+        if files is None:
+            cells += ["0"] * (len(subdirs_dict[bidstype])+1)
+            continue
+        if len(files) == 0:
+            warnings.append("WARNING: Folder {} is empty!!".format(os.path.join(bids_path, sub, seslabel, bidstype)))
+        cells += ["1"] + [str(count) for count in file_counts(files, bidstype)]
+    return cells
+
+def subject_row(sub):
+    '''This function reads the folders of a subject and returns (its CSV cells, its warnings)'''
+    warnings = []
+    row = [sub]
+
+    # DICOMS: there is a DICOM folder for this subject and session, and its sequence folders
+    row += folder_cells(os.path.join(dicoms_path, sub[4:]), warnings, ["RESTING", "T1w_MPR", "T2w_SPC", "pCASL"])
+
+    # BIDS
+    row += bids_cells(sub, warnings)
+
+    # recon-all
+    row += folder_cells(os.path.join(recons_path, sub + "_"+seslabel), warnings)
+
+    # bold preprocessed
+    if (sub in mni_and_native):
+        row.append("1")
     else:
-        file.write("0," * (len(substring_list)+1))
+        row.append("0")
+    return row, warnings
+
+#building the CSV table: subjects are read by n_workers threads, and their rows and warnings kept in subject order
+print("There are {} subjects.".format(len(all_subjects)))
+mni_and_native = set(mni).intersection(native)
+rows = []
+for i, (row, warnings) in enumerate(pool.map(subject_row, all_subjects), 1):
+    print("Subject {} read. {} subject(s) left".format(row[0], len(all_subjects)-i))
+    for warning in warnings:
+        print(warning)
+    rows.append(row)
+pool.shutdown()
 
 if os.path.isdir(os.path.dirname(output_path)) == False: os.mkdir(os.path.dirname(output_path)) 
 
@@ -141,39 +218,5 @@ if os.path.isdir(os.path.dirname(output_path)) == False: os.mkdir(os.path.dirnam
 with open(output_path, 'w') as f:
     writer = csv.writer(f)
     writer.writerow(header_list)    #write header row
-    print("There are {} subjects.".format(len(all_subjects)))
-    i = 1
-    for sub in all_subjects:
-        print("Now writing subject {} in {}. {} subject(s) left".format(sub, output_path, len(all_subjects)-i))
-        f.write(sub+",")
-        
-        # DICOMS
-        simple_write(f, os.path.join(dicoms_path, sub[4:]))     #there is a DICOM folder for this subject and session
-        simple_write(f, os.path.join(dicoms_path, sub[4:], "RESTING"))
-        simple_write(f, os.path.join(dicoms_path, sub[4:], "T1w_MPR"))
-        simple_write(f, os.path.join(dicoms_path, sub[4:], "T2w_SPC"))
-        simple_write(f, os.path.join(dicoms_path, sub[4:], "pCASL"))
-        
-        # BIDS    
-        if sub in bids:     # there is a BIDS folder for this subject and session
-            f.write("1,")
-            bids_write(f, 'func')
-            bids_write(f, 'anat')
-            bids_write(f, 'swi')
-            bids_write(f, 'dwi')
-            bids_write(f, 'perf')
-            bids_write(f, 'fmap')
-        else:
-            f.write("0," * len(bids_header_list))
-        
-        # recon-all
-        simple_write(f,os.path.join(recons_path,sub + "_"+seslabel))
-        
-        # bold preprocessed
-        if (sub in mni) and (sub in native):
-            f.write("1,")
-        else:
-            f.write("0,")
-        
-        f.write("\n")
-        i = i+1
\ No newline at end of file
+    f.write("".join(",".join(row) + ",\n" for row in rows))
+print("Inventory of {} subjects written to {}".format(len(rows), output_path))
\ No newline at end of file
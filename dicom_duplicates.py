@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+############################################
+#######  MRIGHT DUPLICATE EXPORT SCAN  #####
+#######        BBSLab Oct 2025        ######
+############################################
+
+"""
+Finds DICOM exports received more than once (re-exported under another
+subject ID, or copied into two timepoint folders) by grouping the files of
+every dicom/<timepoint>/<subject> folder on SOPInstanceUID and SeriesInstanceUID.
+Headers come from the DICOM header index, so only new or changed files are read.
+
+Run this script to scan the DICOM directory, print the duplicates and save them
+to dicom_duplicates.json. Sort_DICOMS.py and DICOM_to_BIDS.py skip the duplicate
+subject exports listed there when their skip_duplicates option is on.
+"""
+
+import os
+import sys
+import json
+from dicom_index import index_open, index_path, index_update
+
+duplicates_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "dicom_duplicates.json")
+
+# Raw exports of the link sorting mode (<timepoint>_raw/<subject>) are scanned instead of their sorted view.
+# Also used by Sort_DICOMS.py and DICOM_to_BIDS.py: change the suffix here only
+raw_suffix = "_raw"
+
+
+def export_folders(dicoms_path):
+    '''This function returns {"<timepoint>/<subject>": folder} for every subject export of the DICOM directory.
+    When a subject has a raw export (link sorting mode), its raw folder is returned instead of its sorted view'''
+    exports = {}
+    timepoints = sorted(entry.name for entry in os.scandir(dicoms_path) if entry.is_dir() and not entry.name.startswith("."))
+    # Sorted views first, so that raw exports replace them
+    for timepoint_folder in sorted(timepoints, key=lambda name: name.endswith(raw_suffix)):
+        timepoint = timepoint_folder[:-len(raw_suffix)] if timepoint_folder.endswith(raw_suffix) else timepoint_folder
+        with os.scandir(os.path.join(dicoms_path, timepoint_folder)) as subjects:
+            for subject in subjects:
+                if subject.is_dir() and not subject.name.startswith("."):
+                    exports[timepoint + "/" + subject.name] = subject.path
+    return exports
+
+
+def find_duplicates(conn, exports, pool=None):
+    '''This function groups the DICOMs of the given exports by SOPInstanceUID and SeriesInstanceUID and returns the duplicates:
+    {"instances": number of instances stored more than once, "files": number of redundant files,
+     "series": [{"series", "exports"}] for the series found in several exports,
+     "subjects": {duplicate export: export holding all its instances}}.
+    Of two exports with the same instances, the first in (timepoint, subject) order is kept'''
+    sop_files = {}
+    sop_exports = {}
+    export_sops = {}
+    series_exports = {}
+    series_names = {}
+    for export, folder in sorted(exports.items()):
+        sops = export_sops.setdefault(export, set())
+        for path, header in index_update(conn, folder, pool).items():
+            if header is None or header["sop_uid"] is None:
+                continue
+            sop_files.setdefault(header["sop_uid"], []).append(path)
+            sop_exports.setdefault(header["sop_uid"], set()).add(export)
+            sops.add(header["sop_uid"])
+            if header["series_uid"] is not None:
+                series_exports.setdefault(header["series_uid"], set()).add(export)
+                series_names.setdefault(header["series_uid"], "-".join([header["series_number"] or "0", header["protocol_name"] or ""]))
+
+    # An export is a duplicate if another, kept, export holds all its instances. Larger exports are kept first
+    subjects = {}
+    kept = set()
+    for export in sorted(export_sops, key=lambda export: (-len(export_sops[export]), export)):
+        sops = export_sops[export]
+        # Only exports sharing one of its instances can hold them all
+        candidates = sorted(sop_exports[next(iter(sops))] & kept) if sops else []
+        original = next((other for other in candidates if sops <= export_sops[other]), None)
+        if original is None:
+            kept.add(export)
+        else:
+            subjects[export] = original
+
+    series = [{"series": series_names[series_uid], "exports": sorted(series_exports[series_uid])}
+              for series_uid in series_exports if len(series_exports[series_uid]) > 1]
+    series.sort(key=lambda s: (s["exports"], int(float(s["series"].split("-")[0] or 0))))
+    duplicated = [files for files in sop_files.values() if len(files) > 1]
+    return {"instances": len(duplicated), "files": sum(len(files) - 1 for files in duplicated),
+            "series": series, "subjects": dict(sorted(subjects.items()))}
+
+
+def duplicates_load(dicoms_path):
+    '''This function returns {"<timepoint>/<subject>": original export} of the duplicate exports
+    saved for dicoms_path in dicom_duplicates.json (empty if the DICOM directory was never scanned)'''
+    if not os.path.isfile(duplicates_path):
+        return {}
+    with open(duplicates_path, "r") as f:
+        duplicates = json.load(f)
+    if duplicates.get("dicom") != os.path.abspath(dicoms_path):
+        return {}
+    return duplicates["subjects"]
+
+
+if __name__ == '__main__':
+    from concurrent.futures import ThreadPoolExecutor
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+    from meta import meta_func, meta_create
+
+    meta_create()
+    dicoms_path = meta_func("dicom", "the path to the DICOMs folder")  # Path to DICOM directories
+
+    exports = export_folders(dicoms_path)
+    conn = index_open()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        duplicates = find_duplicates(conn, exports, pool)
+    duplicates["dicom"] = os.path.abspath(dicoms_path)
+
+    print("{} subject exports scanned (headers in {})".format(len(exports), index_path))
+    print("{} DICOM instances are stored more than once ({} redundant files)".format(duplicates["instances"], duplicates["files"]))
+    if duplicates["series"]:
+        print("Series found in several exports:")
+        for s in duplicates["series"]:
+            print("  {:<40} {}".format(s["series"], ", ".join(s["exports"])))
+    if duplicates["subjects"]:
+        print("Duplicate subject exports (all their instances are in another export):")
+        for export, original in duplicates["subjects"].items():
+            print("  {} duplicates {}".format(export, original))
+    else:
+        print("No duplicate subject exports found")
+
+    with open(duplicates_path, "w") as f:
+        json.dump(duplicates, f, indent=1)
+    print("Saved to", duplicates_path)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+############################################
+#######   MRIGHT DICOM HEADER INDEX   ######
+#######        BBSLab Oct 2025        ######
+############################################
+
+"""
+On-disk index of DICOM headers, stored next to meta.json.
+Every file is recorded with its size and mtime, so re-runs only parse
+the files that are new or changed since the last scan.
+
+Run this script to build or refresh the index of dicom/<timepoint>.
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+from urllib.request import pathname2url
+import pydicom
+
+index_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "dicom_index.sqlite")
+
+# Bump when index_columns changes: the index is then rebuilt from scratch
+schema_version = 3
+
+# Column name and DICOM tag of every indexed field
+index_columns = [
+    ("modality",           [0x08, 0x60]),
+    ("sop_uid",            [0x08, 0x18]),
+    ("study_uid",          [0x20, 0x0D]),
+    ("series_uid",         [0x20, 0x0E]),
+    ("series_number",      [0x20, 0x11]),
+    ("instance_number",    [0x20, 0x13]),
+    ("protocol_name",      [0x18, 0x1030]),
+    ("series_description", [0x08, 0x103E]),
+    ("image_type",         [0x08, 0x08]),
+    ("acquisition_time",   [0x08, 0x32]),
+    ("images_in_acquisition",        [0x20, 0x1002]),
+    ("number_of_temporal_positions", [0x20, 0x105]),
+    ("number_of_frames",             [0x28, 0x08]),
+    # Other fields of heudiconv's seqinfo (see heuristic_plan.seqinfo_from)
+    ("rows",                     [0x28, 0x10]),
+    ("columns",                  [0x28, 0x11]),
+    ("repetition_time",          [0x18, 0x80]),
+    ("echo_time",                [0x18, 0x81]),
+    ("acquisition_date",         [0x08, 0x22]),
+    ("acquisition_datetime",     [0x08, 0x2A]),
+    ("patient_id",               [0x10, 0x20]),
+    ("patient_age",              [0x10, 0x1010]),
+    ("patient_sex",              [0x10, 0x40]),
+    ("study_description",        [0x08, 0x1030]),
+    ("referring_physician_name", [0x08, 0x90]),
+    ("accession_number",         [0x08, 0x50]),
+]
+# The sequence name comes from (0018,0024) on Siemens E11 and (0018,9005) on Siemens XA
+sequence_name_tags = [[0x18, 0x24], [0x18, 0x9005]]
+
+header_fields = [column for column, _ in index_columns] + ["sequence_name"]
+index_fields = ["path", "size", "mtime", "valid"] + header_fields
+
+# Seconds a connection waits for another process to release the index before failing (SQLite's default is 5)
+index_timeout = 600
+
+index_lock = threading.Lock()
+
+
+def index_open(path=index_path, read_only=False):
+    '''This function opens (and creates or migrates, if needed) the header index.
+    The connection can be shared between threads, all access goes through index_lock.
+    A read-only connection never writes the index file (headers it has to read are not saved):
+    use it when several processes read the index at once, e.g. SLURM array tasks on a shared file system.
+    If the index does not exist yet or is outdated, it gets a private index in memory instead'''
+    if read_only:
+        try:
+            conn = sqlite3.connect("file:{}?mode=ro".format(pathname2url(path)), uri=True, timeout=index_timeout, check_same_thread=False)
+            if conn.execute("PRAGMA user_version").fetchone()[0] == schema_version:
+                conn.execute("PRAGMA query_only = ON")
+                return conn
+            conn.close()
+        except sqlite3.OperationalError:
+            pass
+        path = ":memory:"
+    conn = sqlite3.connect(path, timeout=index_timeout, check_same_thread=False)
+    with index_lock:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+            conn.execute("DROP TABLE IF EXISTS headers")
+            conn.execute("PRAGMA user_version = {}".format(schema_version))
+        conn.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, valid INTEGER, "
+                     + ", ".join(field + " TEXT" for field in header_fields) + ")")
+        conn.execute("CREATE INDEX IF NOT EXISTS headers_series ON headers (series_uid)")
+        conn.execute("CREATE INDEX IF NOT EXISTS headers_sop ON headers (sop_uid)")
+        conn.commit()
+    return conn
+
+
+def read_index_header(dicom_path):
+    '''Read the indexed tags of a DICOM file, without pixel data.
+    Returns None if the file is not a readable DICOM'''
+    try:
+        dcminfo = pydicom.dcmread(dicom_path, stop_before_pixels=True,
+                                  specific_tags=[tag for _, tag in index_columns] + sequence_name_tags)
+    except (pydicom.errors.InvalidDicomError, OSError):
+        return None
+
+    header = {}
+    for column, tag in index_columns:
+        element = dcminfo.get(tag)
+        if element is None or element.value is None:
+            header[column] = None
+        elif element.VM > 1:
+            header[column] = "\\".join(str(value) for value in element.value)
+        else:
+            header[column] = str(element.value)
+    header["sequence_name"] = ""
+    for tag in sequence_name_tags:
+        if dcminfo.get(tag):
+            header["sequence_name"] = str(dcminfo[tag].value)
+            break
+    return header
+
+
+def _read_only(conn):
+    return conn.execute("PRAGMA query_only").fetchone()[0] == 1
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def index_headers(conn, paths, pool=None):
+    '''This function returns {path: header} for the given files (None for non-DICOM files).
+    Only files that are new or changed since they were indexed are parsed,
+    concurrently if a thread pool is given'''
+    paths = [os.path.abspath(path) for path in paths]
+    stats = {path: _stat(path) for path in paths}
+
+    with index_lock:
+        rows = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            cursor = conn.execute("SELECT {} FROM headers WHERE path IN ({})".format(", ".join(index_fields), ", ".join("?" * len(chunk))), chunk)
+            rows.update({row[0]: row for row in cursor})
+
+    headers = {}
+    to_parse = []
+    for path in paths:
+        row = rows.get(path)
+        if row is not None and (row[1], row[2]) == stats[path]:
+            headers[path] = dict(zip(header_fields, row[4:])) if row[3] else None
+        else:
+            to_parse.append(path)
+
+    parsed = pool.map(read_index_header, to_parse) if pool is not None else map(read_index_header, to_parse)
+    new_rows = []
+    for path, header in zip(to_parse, parsed):
+        headers[path] = header
+        values = [header[field] for field in header_fields] if header is not None else [None] * len(header_fields)
+        new_rows.append([path, stats[path][0], stats[path][1], int(header is not None)] + values)
+
+    if new_rows:
+        with index_lock:
+            if not _read_only(conn):
+                conn.executemany("INSERT OR REPLACE INTO headers ({}) VALUES ({})".format(", ".join(index_fields), ", ".join("?" * len(index_fields))), new_rows)
+                conn.commit()
+    return headers
+
+
+def index_add(conn, headers):
+    '''This function indexes files whose headers were already read with read_index_header
+    (e.g. from memory, before the file was written). headers is {path: header or None}'''
+    rows = []
+    for path, header in headers.items():
+        size, mtime = _stat(path)
+        values = [header[field] for field in header_fields] if header is not None else [None] * len(header_fields)
+        rows.append([os.path.abspath(path), size, mtime, int(header is not None)] + values)
+    with index_lock:
+        if rows and not _read_only(conn):
+            conn.executemany("INSERT OR REPLACE INTO headers ({}) VALUES ({})".format(", ".join(index_fields), ", ".join("?" * len(index_fields))), rows)
+            conn.commit()
+
+
+def index_update(conn, folder, pool=None):
+    '''This function brings the index of every file under folder up to date
+    (new, changed and removed files) and returns {path: header} for all of them'''
+    folder = os.path.abspath(folder)
+    paths = []
+    for dirpath, _, filenames in os.walk(folder):
+        paths.extend(os.path.join(dirpath, filename) for filename in filenames)
+
+    headers = index_headers(conn, paths, pool)
+
+    # Forget files that are no longer on disk
+    with index_lock:
+        prefix = os.path.join(folder, "")
+        indexed = [row[0] for row in conn.execute("SELECT path FROM headers WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))]
+        gone = [(path,) for path in indexed if path not in headers]
+        if gone and not _read_only(conn):
+            conn.executemany("DELETE FROM headers WHERE path = ?", gone)
+            conn.commit()
+    return headers
+
+
+def index_query(conn, folder):
+    '''This function returns {path: header} for the valid DICOMs indexed under folder, without touching the disk'''
+    prefix = os.path.join(os.path.abspath(folder), "")
+    with index_lock:
+        cursor = conn.execute("SELECT path, {} FROM headers WHERE valid = 1 AND substr(path, 1, ?) = ?".format(", ".join(header_fields)),
+                              (len(prefix), prefix))
+        return {row[0]: dict(zip(header_fields, row[1:])) for row in cursor}
+
+
+def index_move(conn, moves):
+    '''This function updates the index after files were renamed (renaming keeps size and mtime).
+    moves is a list of (source, destination) paths'''
+    with index_lock:
+        conn.executemany("UPDATE OR REPLACE headers SET path = ? WHERE path = ?",
+                         [(os.path.abspath(dest), os.path.abspath(src)) for src, dest in moves])
+        conn.commit()
+
+
+def index_link(conn, links):
+    '''This function indexes linked copies of already indexed files (same content, size and mtime).
+    links is a list of (source, link) paths'''
+    with index_lock:
+        conn.executemany("INSERT OR REPLACE INTO headers ({0}) SELECT ?, {1} FROM headers WHERE path = ?".format(", ".join(index_fields), ", ".join(index_fields[1:])),
+                         [(os.path.abspath(link), os.path.abspath(src)) for src, link in links])
+        conn.commit()
+
+
+if __name__ == '__main__':
+    from concurrent.futures import ThreadPoolExecutor
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+    from meta import meta_func, meta_create
+
+    meta_create()
+    dicoms_path = meta_func("dicom", "the path to the DICOMs folder")  # Path to DICOM directories
+    timepoint = meta_func("timepoint", "the name of the timepoint folder (e.g., 'TP2')") # Name of timepoint folder
+
+    conn = index_open()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        headers = index_update(conn, os.path.join(dicoms_path, timepoint), pool)
+    n_valid = sum(1 for header in headers.values() if header is not None)
+    print("{} files indexed in {} ({} DICOMs)".format(len(headers), index_path, n_valid))
@@ -60,3 +60,20 @@ def meta_func(var, msg, msg2="", ispath=True):
         with open(json_meta, 'w') as file:
             json.dump(data, file)
     return data[var]
+
+
+def meta_get(var):
+    '''This function returns a value stored at meta.json without prompting
+    (an empty string if it was never set), for unattended scripts'''
+    with open(json_meta, 'r') as file:
+        data = json.load(file)
+    return data.get(var, "")
+
+
+def meta_set(var, value):
+    '''This function stores a value at meta.json without prompting'''
+    with open(json_meta, 'r') as file:
+        data = json.load(file)
+    data[var] = value
+    with open(json_meta, 'w') as file:
+        json.dump(data, file)